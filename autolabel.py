@@ -1,21 +1,16 @@
-import torch
-import torch.nn as nn
-import torch.nn.functional as F
-from torch.autograd import Variable
-from torch.optim.lr_scheduler import StepLR
-import torchvision.models as models
-import numpy as np
+import time
+START = time.time()
 import os
-import math
 import argparse
-import random
-import cv2
-import subprocess
-import time
-from tqdm import tqdm
+import hashlib
+import itertools
+import threading
+import queue
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from support import support_files
 
 
-torch.backends.cudnn.benchmark = True
 parser = argparse.ArgumentParser(description="One Shot Visual Recognition")
 parser.add_argument("-i","--input_dim",type = int, default = 224)
 parser.add_argument("-f","--feature_dim",type = int, default = 64)
@@ -27,6 +22,9 @@ parser.add_argument("-e","--episode",type = int, default= 50000)
 parser.add_argument("-o","--overlay_mask", type = int, default = 1)
 parser.add_argument("-l","--learning_rate", type = float, default = 0.001)
 parser.add_argument("-g","--gpu",type=int, default=0)
+parser.add_argument("-dev","--device",type=str, default='auto')
+parser.add_argument("-nt","--num_threads",type=int, default=0)
+parser.add_argument("-it","--interop_threads",type=int, default=0)
 parser.add_argument("-u","--hidden_unit",type=int,default=10)
 parser.add_argument("-d","--display_query_num",type=int,default=5)
 parser.add_argument("-t","--test_class",type=int,default=1)
@@ -34,12 +32,28 @@ parser.add_argument("-modelf","--feature_encoder_model",type=str,default='models
 parser.add_argument("-modelr","--relation_network_model",type=str,default='models/relation_network.pkl')
 parser.add_argument("-sd","--support_dir",type=str,default='data/african_elephant/supp')
 parser.add_argument("-td","--test_dir",type=str,default='data/african_elephant/test')
+parser.add_argument("-gd","--graph_dir",type=str,default='')
+parser.add_argument("-sc","--support_cache",type=str,default='')
+parser.add_argument("-bs","--batch_size","--batch-size",type=int,default=1)
+parser.add_argument("-nw","--num_workers",type=int,default=4)
+parser.add_argument("-pf","--prefetch",type=int,default=32)
+parser.add_argument("-of","--output_format",type=str,default='overlay',choices=['overlay','mask','bilevel','packbits','rle','archive'])
+parser.add_argument("-rd","--result_dir",type=str,default='result1')
+parser.add_argument("-ww","--writer_workers",type=int,default=2)
+parser.add_argument("-wq","--writer_queue",type=int,default=64)
+parser.add_argument("-tl","--tiled",type=int,default=0)
+parser.add_argument("-to","--tile_overlap",type=float,default=0.25)
+parser.add_argument("-tb","--tile_batch_size",type=int,default=16)
+parser.add_argument("-tsc","--tile_scale",type=float,default=1.0)
+parser.add_argument("-seq","--sequence",type=int,default=0)
+parser.add_argument("-ct","--change_threshold",type=float,default=2.0)
+parser.add_argument("-cs","--change_size",type=int,default=32)
+parser.add_argument("-mr","--max_reuse",type=int,default=30)
+parser.add_argument("-tm","--timing",type=int,default=0)
+parser.add_argument("-tt","--timing_target",type=float,default=2.0)
+parser.add_argument("-bn","--running_stats",type=int,default=0)
 args = parser.parse_args()
 
-os.environ["CUDA_VISIBLE_DEVICES"]=str(np.argmax( [int(x.split()[2]) \
-                                    for x in subprocess.Popen("nvidia-smi -q -d Memory |\
-                                    grep -A4 GPU | grep Free", shell=True, stdout=subprocess.PIPE).stdout.readlines()] ))
-
 # Hyper Parameters
 FEATURE_DIM = args.feature_dim
 RELATION_DIM = args.relation_dim
@@ -55,177 +69,284 @@ DISPLAY_QUERY = args.display_query_num
 TEST_CLASS = args.test_class
 FEATURE_MODEL = args.feature_encoder_model
 RELATION_MODEL = args.relation_network_model
+GRAPH_DIR = args.graph_dir
+SUPPORT_CACHE = args.support_cache
+BATCH_SIZE = args.batch_size
+NUM_WORKERS = args.num_workers
+PREFETCH = args.prefetch
+WRITER_WORKERS = args.writer_workers
+WRITER_QUEUE = args.writer_queue
 
 input_dim = args.input_dim
 overlay_mask = args.overlay_mask
+OUTPUT_FORMAT = args.output_format
+if not overlay_mask and OUTPUT_FORMAT == 'overlay':
+    OUTPUT_FORMAT = 'mask'
 assert (input_dim%224==0)
+assert (BATCH_SIZE>=1)
+assert (NUM_WORKERS>=1)
+
+def check_paths():
+    """Exit with a usage error if an input file or directory is missing."""
+    for name in ('image', 'label'):
+        if not os.path.isdir('%s/%s' % (args.support_dir, name)):
+            parser.error('support directory %s needs image/ and label/ subdirectories' % args.support_dir)
+    if not (os.path.isdir(args.test_dir) or (args.sequence and os.path.isfile(args.test_dir))):
+        parser.error('query directory %s not found' % args.test_dir)
+    models = ['%s/export.json' % GRAPH_DIR] if GRAPH_DIR else [FEATURE_MODEL, RELATION_MODEL]
+    for path in models:
+        if not os.path.exists(path):
+            parser.error('%s not found' % path)
+
+# check the arguments and find the input files before importing torch and
+# the rest, a mistyped path fails at once instead of after the slow imports
+check_paths()
+try:
+    SUPPORT_NAMES = support_files(args.support_dir, SAMPLE_NUM_PER_CLASS)
+except Exception as e:
+    parser.error(str(e))
+# frames of a sequence are named in order, a video file is listed as None
+QUERY_NAMES = sorted(os.listdir(args.test_dir)) if os.path.isdir(args.test_dir) else None
+ARGS_TIME = time.time()
+
+import numpy as np
+import cv2
+import torch
+from tqdm import tqdm
+from device import get_device, set_threads
+from segmenter import FewShotSegmenter, ExportedSegmenter, read_support
+from sequence import KeyframeSelector
+from masks import pack_mask, MaskArchive, RLEWriter
+from postprocess import postprocess, render_overlays
 
-class CNNEncoder(nn.Module):
-    """docstring for ClassName"""
-    def __init__(self):
-        super(CNNEncoder, self).__init__()
-        features = list(models.vgg16_bn(pretrained=False).features)
-        self.layer1 = nn.Sequential(
-                        nn.Conv2d(4,64,kernel_size=3,padding=1)
-                        )
-        self.features = nn.ModuleList(features)[1:]#.eval()
-        # print (nn.Sequential(*list(models.vgg16_bn(pretrained=True).children())[0]))
-        # self.features = nn.ModuleList(features).eval()
-
-    def forward(self,x):
-        results = []
-        x = self.layer1(x)
-        for ii, model in enumerate(self.features):
-            x = model(x)
-            if ii in {4, 11, 21, 31, 41}:
-                results.append(x)
-
-        return x, results
-
-class RelationNetwork(nn.Module):
-    """docstring for RelationNetwork"""
-    def __init__(self):
-        super(RelationNetwork, self).__init__()
-        self.layer1 = nn.Sequential(
-                        nn.Conv2d(1024,512,kernel_size=3,padding=1),
-                        nn.BatchNorm2d(512, momentum=1, affine=True),
-                        nn.ReLU()
-                        )
-        self.layer2 = nn.Sequential(
-                        nn.Conv2d(512,512,kernel_size=3,padding=1),
-                        nn.BatchNorm2d(512, momentum=1, affine=True),
-                        nn.ReLU()
-                        )
-        self.upsample = nn.Upsample(scale_factor=2, mode='bilinear', align_corners=True)
-        self.double_conv1 = nn.Sequential(
-                        nn.Conv2d(1024,512,kernel_size=3,padding=1),
-                        nn.BatchNorm2d(512, momentum=1, affine=True),
-                        nn.ReLU(),
-                        nn.Conv2d(512,512,kernel_size=3,padding=1),
-                        nn.BatchNorm2d(512, momentum=1, affine=True),
-                        nn.ReLU()
-                        ) # 14 x 14
-        self.double_conv2 = nn.Sequential(
-                        nn.Conv2d(1024,256,kernel_size=3,padding=1),
-                        nn.BatchNorm2d(256, momentum=1, affine=True),
-                        nn.ReLU(),
-                        nn.Conv2d(256,256,kernel_size=3,padding=1),
-                        nn.BatchNorm2d(256, momentum=1, affine=True),
-                        nn.ReLU()
-                        ) # 28 x 28
-        self.double_conv3 = nn.Sequential(
-                        nn.Conv2d(512,128,kernel_size=3,padding=1),
-                        nn.BatchNorm2d(128, momentum=1, affine=True),
-                        nn.ReLU(),
-                        nn.Conv2d(128,128,kernel_size=3,padding=1),
-                        nn.BatchNorm2d(128, momentum=1, affine=True),
-                        nn.ReLU()
-                        ) # 56 x 56
-        self.double_conv4 = nn.Sequential(
-                        nn.Conv2d(256,64,kernel_size=3,padding=1),
-                        nn.BatchNorm2d(64, momentum=1, affine=True),
-                        nn.ReLU(),
-                        nn.Conv2d(64,64,kernel_size=3,padding=1),
-                        nn.BatchNorm2d(64, momentum=1, affine=True),
-                        nn.ReLU()
-                        ) # 112 x 112
-        self.double_conv5 = nn.Sequential(
-                        nn.Conv2d(128,64,kernel_size=3,padding=1),
-                        nn.BatchNorm2d(64, momentum=1, affine=True),
-                        nn.ReLU(),
-                        nn.Conv2d(64,1,kernel_size=1,padding=0),
-                        ) # 256 x 256
-
-
-    def forward(self,x,concat_features):
-        out = self.layer1(x)
-        out = self.layer2(out)
-        out = self.upsample(out) #block 1
-        out = torch.cat((out, concat_features[-1]), dim=1)
-        out = self.double_conv1(out)
-        out = self.upsample(out) #block 2
-        out = torch.cat((out, concat_features[-2]), dim=1)
-        out = self.double_conv2(out)
-        out = self.upsample(out) #block 3
-        out = torch.cat((out, concat_features[-3]), dim=1)
-        out = self.double_conv3(out)
-        out = self.upsample(out) #block 4
-        out = torch.cat((out, concat_features[-4]), dim=1)
-        out = self.double_conv4(out)
-        out = self.upsample(out) #block 5
-        out = torch.cat((out, concat_features[-5]), dim=1)
-        out = self.double_conv5(out)
-
-        out = F.sigmoid(out)
-        return out
-
-def get_oneshot_batch(testname):  #shuffle in query_images not done
-    support_images = np.zeros((CLASS_NUM*SAMPLE_NUM_PER_CLASS,3,input_dim,input_dim), dtype=np.float32)
-    support_labels = np.zeros((CLASS_NUM*SAMPLE_NUM_PER_CLASS,CLASS_NUM,input_dim,input_dim), dtype=np.float32)
-    query_images = np.zeros((CLASS_NUM*BATCH_NUM_PER_CLASS,3,input_dim,input_dim), dtype=np.float32)
-    query_labels = np.zeros((CLASS_NUM*BATCH_NUM_PER_CLASS,CLASS_NUM,input_dim,input_dim), dtype=np.float32)
-    zeros = np.zeros((CLASS_NUM*BATCH_NUM_PER_CLASS,1,input_dim,input_dim), dtype=np.float32)
-    class_cnt = 0
-    imgnames = os.listdir('./%s/label' % args.support_dir)
-    testnames = os.listdir('%s' % args.test_dir)
-    indexs = list(range(0,len(imgnames)))[0:5]
-    chosen_index = indexs
-    j = 0
-    for k in chosen_index:
-        # process image
-        image = cv2.imread('%s/image/%s' % (args.support_dir, imgnames[k]))
-        if image is None:
-            print('%s/image/%s' % (args.support_dir, imgnames[k]))
-            raise Exception('cannot load image ')
-        if not image.shape[0] == input_dim:
-          image = cv2.resize(image, (input_dim, input_dim))
-        image = image[:,:,::-1] # bgr to rgb
-        image = image / 255.0
-        image = np.transpose(image, (2,0,1))
-        label = cv2.imread('%s/label/%s' % (args.support_dir, imgnames[k]))[:,:,0]
-        label = cv2.resize(label, (input_dim, input_dim), interpolation=cv2.INTER_NEAREST)
-
-        support_images[k] = image
-        support_labels[k][0] = label
+torch.backends.cudnn.benchmark = True
+IMPORT_TIME = time.time()
+
+def load_query(testname):
+    """Decode one query image into a float32 CHW array, None if it cannot be read.
 
+    With --tiled or --sequence the image is a uint8 RGB frame instead.
+    """
     testimage = cv2.imread('%s/%s' % (args.test_dir, testname))
+    if testimage is None:
+        return None
+    if args.tiled or args.sequence:
+        return to_frame(testimage)
     testimage = cv2.resize(testimage, (input_dim,input_dim))
     testimage = testimage[:,:,::-1] # bgr to rgb
-    testimage = testimage / 255.0
-    testimage = np.transpose(testimage, (2,0,1))
-
-    query_images[0] = testimage
-
-    class_cnt += 1
-    support_images_tensor = torch.from_numpy(support_images)
-    support_labels_tensor = torch.from_numpy(support_labels)
-    support_images_tensor = torch.cat((support_images_tensor,support_labels_tensor), dim=1)
-
-    zeros_tensor = torch.from_numpy(zeros)
-    query_images_tensor = torch.from_numpy(query_images)
-    query_images_tensor = torch.cat((query_images_tensor,zeros_tensor), dim=1)
-    query_labels_tensor = torch.from_numpy(query_labels)
-
-    return support_images_tensor, support_labels_tensor, query_images_tensor, query_labels_tensor
+    testimage = np.transpose(testimage, (2,0,1)).astype(np.float32)
+    testimage /= 255.0
+    return testimage
+
+def to_frame(image):
+    """uint8 RGB image of a decoded BGR image, kept at full resolution when tiled by the segmenter."""
+    if not args.tiled:
+        image = cv2.resize(image, (input_dim,input_dim))
+    return np.ascontiguousarray(image[:,:,::-1])
+
+def video_frames(path):
+    """Yield (name, frame) of every frame of a video file in order."""
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise Exception('cannot open video %s' % path)
+    index = 0
+    while True:
+        ok, frame = capture.read()
+        if not ok:
+            break
+        yield 'frame_%06d.jpg' % index, to_frame(frame)
+        index += 1
+    capture.release()
+
+def segment_sequence(segmenter, prototype, frames, selector, batch_size, max_pending):
+    """Yield (name, frame, pred) of frames in order, only running keyframes through the network.
+
+    Keyframes are segmented `batch_size` at a time; the frames that follow a
+    keyframe until the next one reuse its mask. Frames are yielded as soon
+    as their keyframe is segmented, and at most `max_pending` frames wait
+    for it before a smaller batch is run.
+    """
+    pending, keyframes = [], []
+    last = []  # prediction of the last keyframe segmented
+
+    def flush():
+        if keyframes:
+            if args.tiled:
+                preds = [segmenter.predict_tiled(frame, prototype, args.tile_overlap, args.tile_batch_size,
+                                                 args.tile_scale) for frame in keyframes]
+            else:
+                preds = segmenter.forward(segmenter.preprocess(keyframes), prototype)[:, 0].cpu().numpy()
+            last[:] = [preds[-1]]
+        for name, frame, k in pending:
+            # k is -1 for frames reusing a keyframe of an earlier batch
+            yield name, frame, preds[k] if k >= 0 else last[0]
+        del pending[:], keyframes[:]
+
+    for name, frame in frames:
+        if selector.is_keyframe(frame):
+            if len(keyframes) == batch_size:
+                for result in flush():
+                    yield result
+            keyframes.append(frame)
+        pending.append((name, frame, len(keyframes) - 1))
+        if not keyframes or len(pending) >= max_pending:
+            for result in flush():
+                yield result
+    for result in flush():
+        yield result
+
+def query_stream(testnames, num_workers, prefetch):
+    """Yield (testname, image) in order while background workers decode ahead.
+
+    At most `prefetch` images are in flight at once, so memory stays bounded
+    however long the query list is. Unreadable files are skipped.
+    """
+    testnames = iter(testnames)
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        for testname in itertools.islice(testnames, prefetch):
+            pending.append((testname, pool.submit(load_query, testname)))
+        while pending:
+            testname, future = pending.popleft()
+            for nextname in itertools.islice(testnames, 1):
+                pending.append((nextname, pool.submit(load_query, nextname)))
+            testimage = future.result()
+            if testimage is None:
+                tqdm.write('skip unreadable image %s/%s' % (args.test_dir, testname))
+                continue
+            yield testname, testimage
+
+def query_batches(stream, batch_size):
+    """Group a query stream into (names, 4-channel query tensor) batches."""
+    while True:
+        chunk = list(itertools.islice(stream, batch_size))
+        if not chunk:
+            return
+        query_images = np.zeros((len(chunk),4,input_dim,input_dim), dtype=np.float32)
+        for i, (_, testimage) in enumerate(chunk):
+            query_images[i,0:3] = testimage
+        yield [testname for testname, _ in chunk], torch.from_numpy(query_images)
+
+def model_files():
+    if GRAPH_DIR:
+        return ['%s/support.pt' % GRAPH_DIR, '%s/segment.pt' % GRAPH_DIR]
+    return [FEATURE_MODEL, RELATION_MODEL]
+
+def support_cache_key():
+    """Content hash of the support files plus the checkpoints used to encode them."""
+    key = hashlib.sha1()
+    key.update(('%d %d %d %d' % (input_dim, CLASS_NUM, SAMPLE_NUM_PER_CLASS, args.running_stats)).encode())
+    for imgname, labelname in SUPPORT_NAMES:
+        for path in ('%s/image/%s' % (args.support_dir, imgname), '%s/label/%s' % (args.support_dir, labelname)):
+            key.update(os.path.basename(path).encode())
+            with open(path, 'rb') as f:
+                key.update(f.read())
+    # checkpoints are large, identify them by path, size and mtime instead of content
+    for path in model_files():
+        stat = os.stat(path)
+        key.update(('%s %d %d' % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)).encode())
+    return key.hexdigest()
+
+def get_support_prototype(segmenter):
+    """Support tensors and their summed encoder feature, computed once per run.
+
+    With --support_cache set, the result is also kept on disk keyed by
+    support_cache_key() so later runs on the same support set skip encoding.
+    """
+    cache_path = None
+    if SUPPORT_CACHE:
+        cache_path = '%s/%s.pt' % (SUPPORT_CACHE, support_cache_key())
+        if os.path.exists(cache_path):
+            cached = torch.load(cache_path, map_location='cpu')
+            print("load support cache %s" % cache_path)
+            return cached['support_images'], cached['support_labels'], cached['prototype'].to(segmenter.device)
+
+    samples = segmenter.preprocess(*read_support(args.support_dir, SAMPLE_NUM_PER_CLASS))
+    sample_labels = samples[:, 3:]
+    sample_features = segmenter.encode_support(samples)
+
+    if cache_path is not None:
+        if not os.path.exists(SUPPORT_CACHE):
+            os.makedirs(SUPPORT_CACHE)
+        # write then rename so an interrupted run never leaves a truncated cache entry
+        torch.save({'support_images': samples, 'support_labels': sample_labels,
+                    'prototype': sample_features.cpu()}, cache_path + '.tmp')
+        os.replace(cache_path + '.tmp', cache_path)
+        print("save support cache %s" % cache_path)
+    return samples, sample_labels, sample_features
 
   
-def maskimg(img, mask, edge, color=[0, 0, 255], alpha=0.5):
-    '''
-    img: cv2 image
-    mask: bool or np.where
-    color: BGR triplet [_, _, _]. Default: [0, 255, 255] is yellow.
-    alpha: float [0, 1].
-    Ref: http://www.pyimagesearch.com/2016/03/07/transparent-overlays-with-opencv/
-    '''
-    out = img.copy()
-    img_layer = img.copy()
-    img_layer[mask==255] = color
-    edge_layer = img.copy()
-    edge_layer[edge==255] = color
-    out = cv2.addWeighted(edge_layer, 1, out, 0 , 0, out)
-    out = cv2.addWeighted(img_layer, alpha, out, 1 - alpha, 0, out)
-    return(out)
-
+def render_overlay(image, mask):
+    """BGR uint8 overlay of an RGB image, a (3, H, W) float tensor in [0, 1] or an (H, W, 3) uint8 frame."""
+    if isinstance(image, np.ndarray):
+        image = torch.from_numpy(image).permute(2,0,1).float() / 255.0
+    return render_overlays(image.unsqueeze(0), torch.from_numpy(mask).unsqueeze(0))[0].numpy()
+
+def write_result(path, output_format, mask, image=None, store=None):
+    """Write a boolean mask, or its overlay on the RGB `image`, in the requested format.
+
+    rle and archive append to `store`, a masks.RLEWriter or masks.MaskArchive.
+    """
+    if output_format in ('rle', 'archive'):
+        store.append(os.path.basename(path), mask)
+        return
+    if output_format == 'packbits':
+        # 1 bit per pixel, read back with masks.unpack_mask(**np.load(path))
+        np.savez(os.path.splitext(path)[0] + '.npz', **pack_mask(mask))
+        return
+    if output_format == 'overlay':
+        cv2.imwrite(path, render_overlay(image, mask))
+        return
+    mask = mask.view(np.uint8) * np.uint8(255)
+    if output_format == 'bilevel':
+        # single channel 1-bit png, about 1/24th of the 3-channel mask
+        cv2.imwrite(os.path.splitext(path)[0] + '.png', mask, [cv2.IMWRITE_PNG_BILEVEL, 1])
+        return
+    cv2.imwrite(path, cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR))
+
+class ResultWriter(object):
+    """Render and encode results on background threads, off the inference path.
+
+    Masks are thresholded where they were computed, overlays are rendered
+    here from the mask and its query image.
+
+    put() blocks once `queue_size` results are waiting, so a slow disk
+    throttles inference instead of filling memory.
+    """
+    def __init__(self, output_format, num_workers, queue_size, store=None):
+        self.output_format = output_format
+        self.store = store
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.errors = []
+        self.threads = [threading.Thread(target=self._run) for _ in range(num_workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def put(self, path, mask, image=None):
+        if self.errors:
+            raise self.errors[0]
+        self.queue.put((path, mask, image if self.output_format == 'overlay' else None))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            path, mask, image = item
+            try:
+                write_result(path, self.output_format, mask, image, self.store)
+            except Exception as e:
+                self.errors.append(e)
+
+    def close(self):
+        """Wait for every queued result to be written."""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
 
 
 def main():
@@ -237,99 +358,114 @@ def main():
     # Step 2: init neural networks
     print("init neural networks")
 
-    feature_encoder = CNNEncoder()
-    relation_network = RelationNetwork()
+    device = get_device(args.device, GPU)
+    set_threads(args.num_threads, args.interop_threads)
+    print("running on %s" % device)
 
-    feature_encoder.cuda(GPU)
-    relation_network.cuda(GPU)
-
-    if os.path.exists(FEATURE_MODEL):
-        feature_encoder.load_state_dict(torch.load(FEATURE_MODEL))
-        print("load feature encoder success")
-    else:
-        raise Exception('Can not load feature encoder: %s' % FEATURE_MODEL)
-    if os.path.exists(RELATION_MODEL):
-        relation_network.load_state_dict(torch.load(RELATION_MODEL))
-        print("load relation network success")
+    if GRAPH_DIR:
+        segmenter = ExportedSegmenter(GRAPH_DIR, device)
+        assert (segmenter.input_dim == input_dim), 'graphs in %s were exported for input_dim %d' % (GRAPH_DIR, segmenter.input_dim)
+        print("load exported graphs success")
+        print("warning: exported graphs normalize with the stored batch norm statistics, "
+              "their masks match -bn 1 rather than the default run")
     else:
-        raise Exception('Can not load relation network: %s' % RELATION_MODEL)
-
+        segmenter = FewShotSegmenter(FEATURE_MODEL, RELATION_MODEL, input_dim, device,
+                                     running_stats=bool(args.running_stats))
+        print("load feature encoder and relation network success")
+    model_time = time.time()
 
     print("Testing...")
-    meaniou = 0
     classname = args.support_dir
-    if os.path.exists('result1'):
-        os.system('rm -r result1')
-    if os.path.exists('result.zip'):
-        os.system('rm result.zip')
-    if not os.path.exists('result1'):
-        os.makedirs('result1')
-    if not os.path.exists('./result1/%s' % classname):
-        os.makedirs('./result1/%s' % classname)
-    stick = np.zeros((input_dim*4,input_dim*5,3), dtype=np.uint8)
-    support_image = np.zeros((5, 3, input_dim, input_dim), dtype=np.float32)
-    support_label = np.zeros((5, 1, input_dim, input_dim), dtype=np.float32)
-    supp_demo = np.zeros((input_dim, input_dim*5,3), dtype=np.uint8)
-    supplabel_demo = np.zeros((input_dim, input_dim*5,3), dtype=np.uint8)
-
-    testnames = os.listdir('%s' % args.test_dir)
-    print ('%s testing images in class %s' % (len(testnames), classname))
-
-    for cnt, testname in tqdm(enumerate(testnames), total=len(testnames)):
-        if cv2.imread('%s/%s' % (args.test_dir, testname)) is None:
-            continue
-
-
-        samples, sample_labels, batches, batch_labels = get_oneshot_batch(testname)
-
-        #forward
-        with torch.no_grad():
-          sample_features, _ = feature_encoder(Variable(samples).cuda(GPU))
-          sample_features = sample_features.view(CLASS_NUM,SAMPLE_NUM_PER_CLASS,512,input_dim//32,input_dim//32)
-          sample_features = torch.sum(sample_features,1).squeeze(1) # 1*512*7*7
-          batch_features, ft_list = feature_encoder(Variable(batches).cuda(GPU))
-          sample_features_ext = sample_features.unsqueeze(0).repeat(BATCH_NUM_PER_CLASS*CLASS_NUM,1,1,1,1)
-          batch_features_ext = batch_features.unsqueeze(0).repeat(CLASS_NUM,1,1,1,1)
-          batch_features_ext = torch.transpose(batch_features_ext,0,1)
-          relation_pairs = torch.cat((sample_features_ext,batch_features_ext),2).view(-1,1024,input_dim//32,input_dim//32)
-          output = relation_network(relation_pairs,ft_list).view(-1,CLASS_NUM,input_dim,input_dim)
-
-        classiou = 0
-        for i in range(0, batches.size()[0]):
-            #get prediction
-            pred = output.data.cpu().numpy()[i][0]
-            pred[pred<=0.5] = 0
-            pred[pred>0.5] = 1
-            #vis
-            demo = cv2.cvtColor(pred, cv2.COLOR_GRAY2RGB) * 255
-            stick[input_dim*3:input_dim*4, input_dim*i:input_dim*(i+1),:] = demo.copy()
-
-            testlabel = batch_labels.numpy()[i][0].astype(bool)
-            pred = pred.astype(bool)
-            #compute IOU
-            overlap = testlabel * pred
-            union = testlabel + pred
-            iou = overlap.sum() / float(union.sum())
-            # print ('iou=%0.4f' % iou)
-            classiou += iou
-        classiou /= 5.0
-
-        #visulization
-        if (cnt == 0):
-            for i in range(0, samples.size()[0]):
-                suppimg = np.transpose(samples.numpy()[i][0:3], (1,2,0))[:,:,::-1] * 255
-                supplabel = np.transpose(sample_labels.numpy()[i], (1,2,0))
-                supplabel = cv2.cvtColor(supplabel, cv2.COLOR_GRAY2RGB)
-                supplabel = (supplabel * 255).astype(np.uint8)
-                suppedge = cv2.Canny(supplabel,1,1)
-
-        testimg = np.transpose(batches.numpy()[0][0:3], (1,2,0))[:,:,::-1] * 255
-        testlabel = stick[input_dim*3:input_dim*4, input_dim*i:input_dim*(i+1),:].astype(np.uint8)
-        testedge = cv2.Canny(testlabel,1,1)
-        if overlay_mask:
-          cv2.imwrite('./result1/%s/%s' % (classname,testname), maskimg(testimg, testlabel.copy()[:,:,0], testedge))
-        else:
-          cv2.imwrite('./result1/%s/%s' % (classname,testname), testlabel)
+    # earlier results are kept, results of the same query images are replaced
+    result_dir = './%s/%s' % (args.result_dir, classname)
+    if not os.path.exists(result_dir):
+        os.makedirs(result_dir)
+
+    testnames = QUERY_NAMES
+    if testnames is None:
+        # a video file, decoded in order
+        frame_num = int(cv2.VideoCapture(args.test_dir).get(cv2.CAP_PROP_FRAME_COUNT))
+        print ('%s frames in %s' % (frame_num, args.test_dir))
+    else:
+        frame_num = len(testnames)
+        print ('%s testing images in class %s' % (len(testnames), classname))
+
+    # the support set is the same for every query: load and encode it once
+    _, _, sample_features = get_support_prototype(segmenter)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    ready_time = time.time()
+    if args.timing:
+        # cold start: from the start of the script until queries can be segmented
+        cold_start = ready_time - START
+        print ('startup: arguments and files %.3fs, imports %.3fs, networks %.3fs, support set %.3fs' % (
+            ARGS_TIME - START, IMPORT_TIME - ARGS_TIME, model_time - IMPORT_TIME, ready_time - model_time))
+        print ('cold start %.3fs, target %.2fs%s' % (cold_start, args.timing_target,
+                                                   ' EXCEEDED' if cold_start > args.timing_target else ''))
+
+    if testnames is None:
+        stream = video_frames(args.test_dir)
+    else:
+        stream = query_stream(testnames, NUM_WORKERS, max(PREFETCH, BATCH_SIZE))
+    progress = tqdm(total=frame_num)
+
+    store = None
+    if OUTPUT_FORMAT == 'archive':
+        store = MaskArchive('%s/masks.pkb' % result_dir)
+    elif OUTPUT_FORMAT == 'rle':
+        store = RLEWriter('%s/masks.rle.jsonl' % result_dir)
+    writer = ResultWriter(OUTPUT_FORMAT, WRITER_WORKERS, WRITER_QUEUE, store)
+
+    start = time.time()
+    image_num = 0
+    fractions = []
+    if args.sequence:
+        selector = KeyframeSelector(args.change_threshold, args.change_size, args.max_reuse)
+        for testname, frame, pred in segment_sequence(segmenter, sample_features, stream, selector, BATCH_SIZE,
+                                                         max(PREFETCH, BATCH_SIZE)):
+            image_num += 1
+            progress.update(1)
+            result = postprocess(torch.from_numpy(pred).unsqueeze(0))
+            fractions.append(result['fraction'])
+            writer.put('%s/%s' % (result_dir,testname), result['masks'][0], frame)
+    elif args.tiled:
+        # masks at the original resolution, the tiles of an image are batched instead of images
+        for testname, testimage in stream:
+            image_num += 1
+            progress.update(1)
+            pred = segmenter.predict_tiled(testimage, sample_features, args.tile_overlap,
+                                           args.tile_batch_size, args.tile_scale)
+            result = postprocess(torch.from_numpy(pred).unsqueeze(0))
+            fractions.append(result['fraction'])
+            writer.put('%s/%s' % (result_dir,testname), result['masks'][0], testimage)
+    else:
+        for names, batches in query_batches(stream, BATCH_SIZE):
+            image_num += len(names)
+            progress.update(len(names))
+
+            #forward
+            output = segmenter.forward(batches, sample_features)[:, 0]
+            # thresholded for the whole batch, then moved to the CPU once
+            result = postprocess(output)
+            fractions.append(result['fraction'])
+
+            for i, testname in enumerate(names):
+                writer.put('%s/%s' % (result_dir,testname), result['masks'][i], batches[i, 0:3])
+
+    writer.close()
+    if store is not None:
+        store.close()
+    progress.close()
+    elapsed = time.time() - start
+    print ('%s images in %.2fs, %.2f images/sec (batch size %s)' % (image_num, elapsed, image_num / max(elapsed, 1e-6), BATCH_SIZE))
+    if fractions:
+        fractions = np.concatenate(fractions)
+        print ('mean foreground %.1f%% of the image, %s empty masks' % (100 * fractions.mean(), int((fractions == 0).sum())))
+    if args.sequence:
+        stats = selector.stats()
+        print ('%s forward passes for %s frames, %s avoided (%.0f%%), %.2f frames/sec' % (
+            stats['forwards'], stats['frames'], stats['skipped'], 100 * stats['skipped_ratio'],
+            image_num / max(elapsed, 1e-6)))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,233 @@
+"""Inference benchmark on randomly initialized networks and synthetic images.
+
+    python benchmark.py -o results.json
+    python benchmark.py -i 224 448 -bs 1 8 32 -nt 1 4 -p fp32 bf16 -b baseline.json
+
+No checkpoint or dataset is needed: the networks are built with random
+weights from a fixed seed and the images are noise. For every input_dim,
+batch size, thread count and precision, each stage is run --repeats times
+after --warmup runs:
+
+    support      encoder on the support set, summed into the prototype
+    query        encoder on a batch of queries
+    relation     relation network on the query features and the prototype
+    end_to_end   autolabel.py over a directory of --e2e_images JPEG files
+
+end_to_end runs autolabel.py in a subprocess in fp32, it reports the
+throughput autolabel.py prints and the wall time including start-up.
+Results are written as JSON with the machine they were measured on. With
+-b, they are compared with an earlier results file and the command fails
+if a throughput dropped by more than --tolerance.
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import cv2
+import torch
+
+from device import get_device, set_threads, get_precision, autocast
+from network import CNNEncoder, RelationNetwork, weights_init, shared_statistics, use_batch_statistics
+
+
+def latency_stats(seconds, batch_size):
+    latencies = 1000 * np.array(seconds)
+    return {'latency_ms': {'mean': float(latencies.mean()),
+                           'p50': float(np.percentile(latencies, 50)),
+                           'p90': float(np.percentile(latencies, 90)),
+                           'p99': float(np.percentile(latencies, 99))},
+            'images_per_sec': batch_size / float(np.mean(seconds))}
+
+
+def time_calls(fn, device, warmup, repeats):
+    """Seconds of each of `repeats` calls of fn() after `warmup` calls."""
+    seconds = []
+    for i in range(warmup + repeats):
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        if i >= warmup:
+            seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def benchmark_networks(feature_encoder, relation_network, input_dim, batch_size, shots, precision,
+                       device, warmup, repeats):
+    """Stats of the support, query and relation stages for one configuration."""
+    samples = torch.rand(shots, 4, input_dim, input_dim, device=device)
+    batches = torch.rand(batch_size, 4, input_dim, input_dim, device=device)
+    batches[:, 3] = 0
+    results = {}
+    with torch.no_grad(), autocast(device, precision):
+        def support():
+            with shared_statistics():
+                sample_features, _ = feature_encoder(samples)
+            return torch.sum(sample_features, 0, keepdim=True)
+
+        def query():
+            return feature_encoder(batches)
+
+        prototype = support()
+        batch_features, ft_list = query()
+
+        def relation():
+            return relation_network.forward_ways(prototype, batch_features, ft_list)
+
+        results['support'] = latency_stats(time_calls(support, device, warmup, repeats), shots)
+        results['query'] = latency_stats(time_calls(query, device, warmup, repeats), batch_size)
+        results['relation'] = latency_stats(time_calls(relation, device, warmup, repeats), batch_size)
+    return results
+
+
+def write_synthetic_data(root, images, shots, rng):
+    """A support directory laid out like imgs/example/support and a query directory of noise images."""
+    for name in ('support/image', 'support/label', 'query'):
+        os.makedirs('%s/%s' % (root, name))
+    for i in range(shots):
+        cv2.imwrite('%s/support/image/%d.jpg' % (root, i), rng.randint(0, 256, (375, 500, 3), dtype=np.uint8))
+        label = np.zeros((375, 500), dtype=np.uint8)
+        label[100:300, 150:350] = 255
+        cv2.imwrite('%s/support/label/%d.png' % (root, i), label)
+    for i in range(images):
+        cv2.imwrite('%s/query/%05d.jpg' % (root, i), rng.randint(0, 256, (375, 500, 3), dtype=np.uint8))
+
+
+def benchmark_end_to_end(root, models, input_dim, batch_size, threads, images, device):
+    """Throughput of autolabel.py over the synthetic query directory.
+
+    autolabel.py runs in `root` with relative directories, it writes its
+    masks to <result_dir>/<support_dir> under the working directory.
+    """
+    autolabel = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autolabel.py')
+    command = [sys.executable, autolabel, '-sd', 'support', '-td', 'query',
+               '-modelf', models[0], '-modelr', models[1], '-i', str(input_dim), '-bs', str(batch_size),
+               '-nt', str(threads), '-dev', str(device), '-rd', 'result', '-of', 'mask']
+    start = time.perf_counter()
+    output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=root,
+                            universal_newlines=True, check=True).stdout
+    wall = time.perf_counter() - start
+    shutil.rmtree('%s/result' % root)
+    match = re.search(r'(\d+) images in ([\d.]+)s, ([\d.]+) images/sec', output)
+    if match is None:
+        raise Exception('unexpected autolabel.py output:\n%s' % output)
+    return {'images_per_sec': float(match.group(3)), 'images': int(match.group(1)),
+            'wall_seconds': wall, 'wall_images_per_sec': images / wall}
+
+
+def result_key(result):
+    return (result['stage'], result['input_dim'], result['batch_size'], result['threads'], result['precision'])
+
+
+def compare(results, baseline, tolerance):
+    """Print throughput against the baseline results, returns the regressed results."""
+    baseline = {result_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        base = baseline.get(result_key(result))
+        if base is None:
+            continue
+        ratio = result['images_per_sec'] / base['images_per_sec']
+        regressed = ratio < 1 - tolerance
+        print("%-10s input_dim %d batch %d threads %d %s: %.2f vs %.2f images/sec, %+.1f%%%s" % (
+            result_key(result) + (result['images_per_sec'], base['images_per_sec'], 100 * (ratio - 1),
+                                  ' REGRESSION' if regressed else '')))
+        if regressed:
+            regressions.append(result)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inference benchmark")
+    parser.add_argument("-i", "--input_dims", type=int, nargs='+', default=[224, 448])
+    parser.add_argument("-bs", "--batch_sizes", type=int, nargs='+', default=[1, 8])
+    parser.add_argument("-nt", "--threads", type=int, nargs='+', default=[0])
+    parser.add_argument("-p", "--precisions", type=str, nargs='+', default=['fp32'])
+    parser.add_argument("-st", "--stages", type=str, nargs='+',
+                        default=['support', 'query', 'relation', 'end_to_end'],
+                        choices=['support', 'query', 'relation', 'end_to_end'])
+    parser.add_argument("-s", "--sample_num_per_class", type=int, default=5)
+    parser.add_argument("-w", "--warmup", type=int, default=3)
+    parser.add_argument("-n", "--repeats", type=int, default=20)
+    parser.add_argument("-ei", "--e2e_images", type=int, default=64)
+    parser.add_argument("-dev", "--device", type=str, default='auto')
+    parser.add_argument("-g", "--gpu", type=int, default=0)
+    parser.add_argument("-seed", "--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", type=str, default='benchmark.json')
+    parser.add_argument("-b", "--baseline", type=str, default='')
+    parser.add_argument("-tol", "--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    device = get_device(args.device, args.gpu)
+    torch.manual_seed(args.seed)
+    feature_encoder = CNNEncoder()
+    relation_network = RelationNetwork()
+    relation_network.apply(weights_init)
+    feature_encoder.to(device).eval()
+    relation_network.to(device).eval()
+    default_threads = torch.get_num_threads()
+
+    root = tempfile.mkdtemp(prefix='fss_benchmark_')
+    results = []
+    try:
+        if 'end_to_end' in args.stages:
+            models = ('%s/feature_encoder.pkl' % root, '%s/relation_network.pkl' % root)
+            torch.save(feature_encoder.state_dict(), models[0])
+            torch.save(relation_network.state_dict(), models[1])
+            write_synthetic_data(root, args.e2e_images, args.sample_num_per_class,
+                                 np.random.RandomState(args.seed))
+        # batch norm as FewShotSegmenter runs it by default, after the checkpoints are saved
+        use_batch_statistics(feature_encoder)
+        use_batch_statistics(relation_network)
+        for input_dim in args.input_dims:
+            for threads in args.threads:
+                set_threads(threads or default_threads)
+                for batch_size in args.batch_sizes:
+                    first = len(results)
+                    config = {'input_dim': input_dim, 'batch_size': batch_size,
+                              'threads': threads or default_threads}
+                    for precision in args.precisions:
+                        precision = get_precision(precision, device)
+                        stats = benchmark_networks(feature_encoder, relation_network, input_dim, batch_size,
+                                                   args.sample_num_per_class, precision, device,
+                                                   args.warmup, args.repeats)
+                        for stage in ('support', 'query', 'relation'):
+                            if stage in args.stages:
+                                results.append(dict(config, stage=stage, precision=precision, **stats[stage]))
+                    if 'end_to_end' in args.stages:
+                        stats = benchmark_end_to_end(root, models, input_dim, batch_size, threads,
+                                                     args.e2e_images, device)
+                        results.append(dict(config, stage='end_to_end', precision='fp32', **stats))
+                    for result in results[first:]:
+                        print("%-10s input_dim %d batch %d threads %d %s: %.2f images/sec" % (
+                            result_key(result) + (result['images_per_sec'],)))
+    finally:
+        shutil.rmtree(root)
+
+    report = {'machine': {'platform': platform.platform(), 'processor': platform.processor(),
+                          'cpu_count': os.cpu_count(), 'python': platform.python_version(),
+                          'torch': torch.__version__, 'device': str(device)},
+              'config': vars(args), 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("results written to %s" % args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print('FAILED: %d regressions over %.0f%%' % (len(regressions), 100 * args.tolerance))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""Episode sampling for FSS-1000 training.
+
+The dataset is arranged as ``<root>/<class>/image/<name>`` with the mask of
+each image in ``<root>/<class>/label/<name>``; image and label are paired by
+file stem. The directory tree is listed once into an index, and the images
+can optionally be decoded and resized once into a single uint8 ``.npy``
+cache that episodes are memory-mapped from.
+"""
+import os
+import json
+import random
+import time
+import numpy as np
+import cv2
+import torch
+
+
+def build_index(root):
+    """List every class under `root` as (classname, [(image, label), ...])."""
+    index = []
+    for classname in sorted(os.listdir(root)):
+        imagenames = {os.path.splitext(name)[0]: name
+                      for name in os.listdir('%s/%s/image' % (root, classname))}
+        pairs = []
+        for labelname in sorted(os.listdir('%s/%s/label' % (root, classname))):
+            stem = os.path.splitext(labelname)[0]
+            if stem in imagenames:
+                pairs.append((imagenames[stem], labelname))
+        index.append((classname, pairs))
+    return index
+
+
+def load_pair(root, classname, imgname, labelname, input_dim):
+    """Decode one image (uint8 RGB, CHW) and its label (uint8, HW) at input_dim."""
+    image = cv2.imread('%s/%s/image/%s' % (root, classname, imgname))
+    if image is None:
+        raise Exception('cannot load image %s/%s/image/%s' % (root, classname, imgname))
+    if not image.shape[:2] == (input_dim, input_dim):
+        image = cv2.resize(image, (input_dim, input_dim))
+    image = np.transpose(image[:, :, ::-1], (2, 0, 1))  # bgr to rgb
+    label = cv2.imread('%s/%s/label/%s' % (root, classname, labelname))
+    if label is None:
+        raise Exception('cannot load label %s/%s/label/%s' % (root, classname, labelname))
+    label = label[:, :, 0]
+    if not label.shape[:2] == (input_dim, input_dim):
+        label = cv2.resize(label, (input_dim, input_dim),
+                           interpolation=cv2.INTER_NEAREST)
+    return image, label
+
+
+def build_cache(root, index, input_dim, path):
+    """Write the whole dataset into `path` as a (N, 4, input_dim, input_dim) uint8 array.
+
+    Channels 0-2 hold the RGB image and channel 3 its label. The root,
+    input_dim and index are stored next to it in `path`.json.
+    """
+    total = sum(len(pairs) for _, pairs in index)
+    # without metadata an old data file is never loaded, even if the build is cut short
+    if os.path.exists(path + '.json'):
+        os.remove(path + '.json')
+    tmp_path = path + '.tmp'
+    data = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                     shape=(total, 4, input_dim, input_dim))
+    n = 0
+    for classname, pairs in index:
+        for imgname, labelname in pairs:
+            data[n, 0:3], data[n, 3] = load_pair(root, classname, imgname, labelname, input_dim)
+            n += 1
+    data.flush()
+    del data
+    os.replace(tmp_path, path)
+    with open(path + '.json.tmp', 'w') as f:
+        json.dump({'root': os.path.abspath(root), 'input_dim': input_dim, 'index': index}, f)
+    os.replace(path + '.json.tmp', path + '.json')
+
+
+def load_cache(path, root, input_dim, index):
+    """Memory-map a cache written by build_cache(), None if missing or stale.
+
+    The cache is stale unless it was built from `root` at `input_dim` with
+    the same `index`, the current listing of `root`.
+    """
+    if not (os.path.exists(path) and os.path.exists(path + '.json')):
+        return None
+    with open(path + '.json') as f:
+        meta = json.load(f)
+    cached_index = [(classname, [tuple(pair) for pair in pairs]) for classname, pairs in meta['index']]
+    if meta.get('root') != os.path.abspath(root) or meta['input_dim'] != input_dim or cached_index != index:
+        return None
+    return cached_index, np.load(path, mmap_mode='r')
+
+
+class EpisodeSampler(object):
+    """Sample few-shot episodes from an indexed dataset.
+
+    Each episode picks `class_num` classes and, per class, `sample_num`
+    support and `batch_num` query images. With `cache_path` set, images are
+    read from the memory-mapped cache (built on first use, rebuilt when the
+    files under `root` changed) instead of being decoded from disk every
+    episode. Classes named in `exclude` stay in the
+    index but are never sampled.
+    """
+
+    def __init__(self, root, input_dim, class_num, sample_num, batch_num, cache_path='', exclude=()):
+        self.root = root
+        self.input_dim = input_dim
+        self.class_num = class_num
+        self.sample_num = sample_num
+        self.batch_num = batch_num
+        self.data = None
+        self.index = build_index(root)
+        if cache_path:
+            cached = load_cache(cache_path, root, input_dim, self.index)
+            if cached is None:
+                print('building dataset cache %s' % cache_path)
+                build_cache(root, self.index, input_dim, cache_path)
+                cached = load_cache(cache_path, root, input_dim, self.index)
+            self.index, self.data = cached
+        # position of each class's first image in the cache
+        self.offsets = np.cumsum([0] + [len(pairs) for _, pairs in self.index])[:-1]
+        self.classes = [i for i, (classname, pairs) in enumerate(self.index)
+                        if len(pairs) >= sample_num + batch_num and classname not in exclude]
+
+    def load(self, class_index, k):
+        """uint8 image (3, H, W) and label (H, W) of the k-th image of a class."""
+        if self.data is not None:
+            item = self.data[self.offsets[class_index] + k]
+            return item[0:3], item[3]
+        classname, pairs = self.index[class_index]
+        imgname, labelname = pairs[k]
+        return load_pair(self.root, classname, imgname, labelname, self.input_dim)
+
+    def sample(self, rng=random):
+        """One episode: support images+labels, support labels, query images, query labels, classes."""
+        input_dim = self.input_dim
+        chosen_classes = rng.sample(self.classes, self.class_num)
+        support_images = np.zeros(
+            (self.class_num*self.sample_num, 3, input_dim, input_dim), dtype=np.float32)
+        support_labels = np.zeros(
+            (self.class_num*self.sample_num, self.class_num, input_dim, input_dim), dtype=np.float32)
+        query_images = np.zeros(
+            (self.class_num*self.batch_num, 4, input_dim, input_dim), dtype=np.float32)
+        query_labels = np.zeros(
+            (self.class_num*self.batch_num, self.class_num, input_dim, input_dim), dtype=np.float32)
+        for class_cnt, i in enumerate(chosen_classes):
+            chosen_index = rng.sample(range(len(self.index[i][1])),
+                                      self.sample_num + self.batch_num)
+            for j, k in enumerate(chosen_index):
+                image, label = self.load(i, k)
+                if j < self.sample_num:
+                    support_images[class_cnt*self.sample_num + j] = image
+                    support_labels[class_cnt*self.sample_num + j][0] = label
+                else:
+                    j = class_cnt*self.batch_num + j - self.sample_num
+                    query_images[j, 0:3] = image
+                    query_labels[j][class_cnt] = label
+        support_images /= 255.0
+        query_images /= 255.0
+
+        support_images_tensor = torch.from_numpy(support_images)
+        support_labels_tensor = torch.from_numpy(support_labels)
+        support_images_tensor = torch.cat(
+            (support_images_tensor, support_labels_tensor), dim=1)
+        # the query's label channel is left at zero
+        query_images_tensor = torch.from_numpy(query_images)
+        query_labels_tensor = torch.from_numpy(query_labels)
+
+        return support_images_tensor, support_labels_tensor, query_images_tensor, query_labels_tensor, chosen_classes
+
+
+class EpisodeDataset(torch.utils.data.IterableDataset):
+    """Episodes `start` to `stop` of a run, for use with a DataLoader.
+
+    Episode n is drawn with its own generator seeded from (seed, n), so the sequence
+    only depends on the seed: it is the same for any number of workers and
+    when a run is resumed part way. Workers take episodes round-robin, which
+    is also the order the DataLoader returns them in.
+
+    In data-parallel training, step n of `rank` draws episode
+    n * world_size + rank, so ranks never train on the same episode.
+    """
+
+    def __init__(self, sampler, start, stop, seed, rank=0, world_size=1):
+        super(EpisodeDataset, self).__init__()
+        self.sampler = sampler
+        self.start = start
+        self.stop = stop
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        for episode in range(self.start + worker_id, self.stop, num_workers):
+            episode = episode * self.world_size + self.rank
+            yield self.sampler.sample(random.Random(self.seed * 1000003 + episode))
+
+
+def episode_loader(sampler, start, stop, seed, num_workers=0, prefetch_factor=2, pin_memory=False,
+                   rank=0, world_size=1):
+    """DataLoader assembling future episodes on `num_workers` processes."""
+    kwargs = {}
+    if num_workers > 0:
+        kwargs['prefetch_factor'] = prefetch_factor
+    return torch.utils.data.DataLoader(
+        EpisodeDataset(sampler, start, stop, seed, rank, world_size), batch_size=None,
+        num_workers=num_workers, pin_memory=pin_memory, **kwargs)
+
+
+def benchmark(sampler, episodes):
+    """Episodes per second drawn from `sampler`."""
+    start = time.time()
+    for _ in range(episodes):
+        sampler.sample()
+    return episodes / max(time.time() - start, 1e-6)
@@ -0,0 +1,59 @@
+"""Device selection shared by the training and labeling scripts."""
+import resource
+import torch
+
+PRECISIONS = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def get_device(name='auto', gpu=0):
+    """torch.device for 'cpu', 'cuda', 'cuda:N' or 'auto'.
+
+    'auto' uses cuda:`gpu` when CUDA is available and the CPU otherwise.
+    """
+    if name == 'auto':
+        name = 'cuda:%d' % gpu if torch.cuda.is_available() else 'cpu'
+    device = torch.device(name)
+    if device.type == 'cuda' and not torch.cuda.is_available():
+        raise Exception('CUDA is not available, use --device cpu')
+    return device
+
+
+def set_threads(num_threads=0, interop_threads=0):
+    """Set the intra-op and inter-op CPU thread counts, 0 keeps the torch default.
+
+    Must be called before the first forward pass.
+    """
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if interop_threads > 0:
+        torch.set_num_interop_threads(interop_threads)
+
+
+def get_precision(name, device):
+    """Resolve 'fp32', 'fp16', 'bf16' or 'auto' for `device`.
+
+    'auto' is bf16 on the CPU and on GPUs that support it, fp16 on other
+    GPUs. fp16 autocast needs CUDA.
+    """
+    if name == 'auto':
+        if device.type == 'cuda' and not torch.cuda.is_bf16_supported():
+            return 'fp16'
+        return 'bf16'
+    if name not in PRECISIONS:
+        raise Exception('unknown precision %s, use one of %s' % (name, ', '.join(sorted(PRECISIONS))))
+    if name == 'fp16' and device.type != 'cuda':
+        raise Exception('fp16 needs a CUDA device, use bf16 on the CPU')
+    return name
+
+
+def autocast(device, precision):
+    """Autocast context for `precision`, a no-op for fp32."""
+    return torch.autocast(device_type=device.type, dtype=PRECISIONS[precision],
+                          enabled=precision != 'fp32')
+
+
+def peak_memory(device):
+    """Peak memory in bytes: allocated tensors on CUDA, the process's max RSS on the CPU."""
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
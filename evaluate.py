@@ -0,0 +1,153 @@
+"""Evaluate a model on the FSS-1000 test classes.
+
+    python evaluate.py -dr fewshot_data -ts fss_test_set.txt -o report.json
+
+For every class listed in the test set (laid out in -dr as described in
+dataset.py), each episode takes `shots` random support images and segments
+the remaining images of the class, or --queries of them, in batches. IoU is
+computed on the whole batch at once. The JSON report holds the per-class
+and mean IoU and the timing; --min_miou and --min_images_per_sec make the
+command fail when the model is below either, for gating promotions.
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import numpy as np
+import torch
+
+from dataset import EpisodeSampler
+from device import get_device, set_threads
+from segmenter import FewShotSegmenter, ExportedSegmenter
+from postprocess import batch_iou
+
+
+def class_batch(sampler, class_index, ks, with_labels):
+    """(len(ks), 4, H, W) float input tensor and (len(ks), H, W) boolean labels of images of a class.
+
+    The label channel of the input is filled for support images only.
+    """
+    input_dim = sampler.input_dim
+    images = np.zeros((len(ks), 4, input_dim, input_dim), dtype=np.float32)
+    labels = np.zeros((len(ks), input_dim, input_dim), dtype=bool)
+    for i, k in enumerate(ks):
+        image, label = sampler.load(class_index, k)
+        images[i, 0:3] = image
+        if with_labels:
+            images[i, 3] = label
+        labels[i] = label > 127
+    images[:, 0:3] /= 255.0
+    return torch.from_numpy(images), torch.from_numpy(labels)
+
+
+def evaluate(segmenter, sampler, classes, shots=5, queries=0, episodes=1, batch_size=16, seed=0):
+    """Report dict of `segmenter` on the sampler's classes named in `classes`."""
+    rng = random.Random(seed)
+    device = segmenter.device
+    report = {'classes': {}}
+    latencies = []
+    total_images = 0
+    model_seconds = 0.0
+    start = time.time()
+    for class_index, (classname, pairs) in enumerate(sampler.index):
+        if classname not in classes or len(pairs) <= shots:
+            continue
+        ious = []
+        for episode in range(episodes):
+            ks = rng.sample(range(len(pairs)), len(pairs))
+            support_ks, query_ks = ks[:shots], ks[shots:]
+            if queries:
+                query_ks = query_ks[:queries]
+            samples, _ = class_batch(sampler, class_index, support_ks, True)
+            prototype = segmenter.encode_support(samples)
+            for i in range(0, len(query_ks), batch_size):
+                batches, labels = class_batch(sampler, class_index, query_ks[i:i+batch_size], False)
+                batch_start = time.time()
+                output = segmenter.forward(batches, prototype)[:, 0]
+                ious.append(batch_iou(output, labels.to(device)).cpu())
+                batch_seconds = time.time() - batch_start
+                model_seconds += batch_seconds
+                latencies.append(1000 * batch_seconds / len(labels))
+        ious = torch.cat(ious)
+        total_images += len(ious)
+        report['classes'][classname] = {'iou': float(ious.mean()), 'images': len(ious)}
+    elapsed = time.time() - start
+
+    class_ious = [result['iou'] for result in report['classes'].values()]
+    report.update({
+        'mean_iou': float(np.mean(class_ious)) if class_ious else float('nan'),
+        'class_num': len(class_ious),
+        'images': total_images,
+        'seconds': elapsed,
+        'model_seconds': model_seconds,
+        'images_per_sec': total_images / max(elapsed, 1e-6),
+        'model_images_per_sec': total_images / max(model_seconds, 1e-6),
+        'latency_ms_per_image': {'mean': float(np.mean(latencies)) if latencies else 0.0,
+                                 'p50': float(np.percentile(latencies, 50)) if latencies else 0.0,
+                                 'p90': float(np.percentile(latencies, 90)) if latencies else 0.0},
+        'config': {'shots': shots, 'queries': queries, 'episodes': episodes,
+                   'batch_size': batch_size, 'seed': seed, 'input_dim': sampler.input_dim,
+                   'device': str(device)},
+    })
+    return report
+
+
+def read_test_set(path):
+    with open(path) as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate on the FSS-1000 test classes")
+    parser.add_argument("-i", "--input_dim", type=int, default=224)
+    parser.add_argument("-s", "--sample_num_per_class", type=int, default=5)
+    parser.add_argument("-q", "--queries", type=int, default=0)
+    parser.add_argument("-ep", "--episodes", type=int, default=1)
+    parser.add_argument("-bs", "--batch_size", type=int, default=16)
+    parser.add_argument("-modelf", "--feature_encoder_model", type=str, default='models/feature_encoder.pkl')
+    parser.add_argument("-modelr", "--relation_network_model", type=str, default='models/relation_network.pkl')
+    parser.add_argument("-gd", "--graph_dir", type=str, default='')
+    parser.add_argument("-bn", "--running_stats", action='store_true')
+    parser.add_argument("-dr", "--data_dir", type=str, default='support')
+    parser.add_argument("-dc", "--data_cache", type=str, default='')
+    parser.add_argument("-ts", "--test_set", type=str, default='fss_test_set.txt')
+    parser.add_argument("-o", "--output", type=str, default='')
+    parser.add_argument("-g", "--gpu", type=int, default=0)
+    parser.add_argument("-dev", "--device", type=str, default='auto')
+    parser.add_argument("-nt", "--num_threads", type=int, default=0)
+    parser.add_argument("-seed", "--seed", type=int, default=0)
+    parser.add_argument("--min_miou", type=float, default=None)
+    parser.add_argument("--min_images_per_sec", type=float, default=None)
+    args = parser.parse_args()
+
+    set_threads(args.num_threads)
+    device = get_device(args.device, args.gpu)
+    if args.graph_dir:
+        segmenter = ExportedSegmenter(args.graph_dir, device)
+    else:
+        segmenter = FewShotSegmenter(args.feature_encoder_model, args.relation_network_model,
+                                     args.input_dim, device, running_stats=args.running_stats)
+    sampler = EpisodeSampler(args.data_dir, segmenter.input_dim, 1, args.sample_num_per_class, 0,
+                             args.data_cache)
+    report = evaluate(segmenter, sampler, read_test_set(args.test_set), args.sample_num_per_class,
+                      args.queries, args.episodes, args.batch_size, args.seed)
+    print("mean IoU %.4f over %d classes, %d images, %.2f images/sec (%.2f model only)" % (
+        report['mean_iou'], report['class_num'], report['images'],
+        report['images_per_sec'], report['model_images_per_sec']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    failed = []
+    if args.min_miou is not None and not report['mean_iou'] >= args.min_miou:
+        failed.append('mean IoU %.4f < %.4f' % (report['mean_iou'], args.min_miou))
+    if args.min_images_per_sec is not None and report['model_images_per_sec'] < args.min_images_per_sec:
+        failed.append('%.2f images/sec < %.2f' % (report['model_images_per_sec'], args.min_images_per_sec))
+    if failed:
+        print('FAILED: %s' % ', '.join(failed))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
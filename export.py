@@ -0,0 +1,157 @@
+"""Export the networks as inference graphs with BatchNorm folded away.
+
+    python export.py -modelf models/feature_encoder.pkl \
+        -modelr models/relation_network.pkl -o models/graph
+    python autolabel.py -gd models/graph -sd ... -td ...
+
+Two graphs are written, each as TorchScript (.pt) and ONNX (.onnx):
+
+    support   support images (N, 4, H, W) -> prototype (1, 512, H/32, W/32)
+    segment   queries (N, 4, H, W), prototype -> probabilities (N, 1, H, W)
+
+segment runs the encoder and the relation network as one graph. export.json
+records the input_dim the graphs were traced at; ExportedSegmenter in
+segmenter.py loads them without building the networks.
+
+Folding uses the batch norm statistics stored in the checkpoints, so the
+graphs match FewShotSegmenter with running_stats=True, not its default of
+normalizing by input statistics. After exporting, the deviation from both
+is printed for random inputs.
+"""
+import os
+import json
+import argparse
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from network import CNNEncoder, RelationNetwork
+from segmenter import load_network, FewShotSegmenter, ExportedSegmenter
+
+
+def fold_batchnorm(network):
+    """Fold every BatchNorm2d into the Conv2d just before it, in place.
+
+    Modules are visited in registration order, which for CNNEncoder and
+    RelationNetwork is also execution order. Folded BatchNorms become
+    nn.Identity so module indices (CNNEncoder's skip outputs) do not move.
+    """
+    leaves = [(name, module) for name, module in network.named_modules()
+              if len(list(module.children())) == 0]
+    folded = 0
+    for (conv_name, conv), (bn_name, bn) in zip(leaves, leaves[1:]):
+        if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d) \
+                and bn.num_features == conv.out_channels:
+            set_module(network, conv_name, fuse_conv_bn_eval(conv, bn))
+            set_module(network, bn_name, nn.Identity())
+            folded += 1
+    return folded
+
+
+def set_module(network, name, module):
+    parent_name, _, child_name = name.rpartition('.')
+    parent = network.get_submodule(parent_name) if parent_name else network
+    setattr(parent, child_name, module)
+
+
+class SupportGraph(nn.Module):
+    """Support images to the summed encoder feature."""
+
+    def __init__(self, feature_encoder):
+        super(SupportGraph, self).__init__()
+        self.feature_encoder = feature_encoder
+
+    def forward(self, samples):
+        sample_features, _ = self.feature_encoder(samples)
+        return torch.sum(sample_features, 0, keepdim=True)
+
+
+class SegmentGraph(nn.Module):
+    """Query images and a support prototype to foreground probabilities."""
+
+    def __init__(self, feature_encoder, relation_network):
+        super(SegmentGraph, self).__init__()
+        self.feature_encoder = feature_encoder
+        self.relation_network = relation_network
+
+    def forward(self, batches, prototype):
+        batch_features, ft_list = self.feature_encoder(batches)
+        relation_pairs = torch.cat((prototype.expand_as(batch_features), batch_features), 1)
+        return self.relation_network(relation_pairs, ft_list)
+
+
+def export(feature_encoder, relation_network, input_dim, output_dir, onnx=True, opset=13):
+    """Fold, trace and save both graphs of eval-mode CPU networks into `output_dir`."""
+    print("folded %d BatchNorm layers" % (fold_batchnorm(feature_encoder) + fold_batchnorm(relation_network)))
+    support = SupportGraph(feature_encoder).eval()
+    segment = SegmentGraph(feature_encoder, relation_network).eval()
+    samples = torch.zeros(5, 4, input_dim, input_dim)
+    batches = torch.zeros(2, 4, input_dim, input_dim)
+    with torch.no_grad():
+        prototype = support(samples)
+        graphs = {'support': (support, (samples,), ['samples'], ['prototype'],
+                              {'samples': {0: 'shots'}}),
+                  'segment': (segment, (batches, prototype), ['batches', 'prototype'], ['output'],
+                              {'batches': {0: 'batch'}, 'output': {0: 'batch'}})}
+        for name, (graph, inputs, input_names, output_names, dynamic_axes) in graphs.items():
+            traced = torch.jit.trace(graph, inputs)
+            traced = torch.jit.freeze(traced)
+            torch.jit.save(traced, '%s/%s.pt' % (output_dir, name))
+            if onnx:
+                torch.onnx.export(graph, inputs, '%s/%s.onnx' % (output_dir, name),
+                                  input_names=input_names, output_names=output_names,
+                                  dynamic_axes=dynamic_axes, opset_version=opset)
+    with open('%s/export.json' % output_dir, 'w') as f:
+        json.dump({'input_dim': input_dim}, f)
+
+
+def compare(graph_dir, feature_model, relation_model, input_dim, seed=0):
+    """Deviation of the exported graphs from FewShotSegmenter on random inputs.
+
+    Returns {running_stats: (max probability difference, fraction of mask
+    pixels that differ)} for both batch norm modes.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    samples = torch.rand(5, 4, input_dim, input_dim, generator=generator)
+    samples[:, 3] = (samples[:, 3] > 0.5).float() * 255
+    batches = torch.rand(2, 4, input_dim, input_dim, generator=generator)
+    batches[:, 3] = 0
+    exported = ExportedSegmenter(graph_dir, 'cpu')
+    output = exported.forward(batches, exported.encode_support(samples))
+    deviations = {}
+    for running_stats in (False, True):
+        segmenter = FewShotSegmenter(feature_model, relation_model, input_dim, 'cpu', running_stats=running_stats)
+        reference = segmenter.forward(batches, segmenter.encode_support(samples))
+        deviations[running_stats] = (float((output - reference).abs().max()),
+                                     float(((output > 0.5) != (reference > 0.5)).float().mean()))
+    return deviations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export inference graphs")
+    parser.add_argument("-i", "--input_dim", type=int, default=224)
+    parser.add_argument("-modelf", "--feature_encoder_model", type=str, default='models/feature_encoder.pkl')
+    parser.add_argument("-modelr", "--relation_network_model", type=str, default='models/relation_network.pkl')
+    parser.add_argument("-o", "--output_dir", type=str, default='models/graph')
+    parser.add_argument("--no_onnx", action='store_true')
+    parser.add_argument("--opset", type=int, default=13)
+    args = parser.parse_args()
+
+    device = torch.device('cpu')
+    feature_encoder = load_network(CNNEncoder, args.feature_encoder_model, device)
+    relation_network = load_network(RelationNetwork, args.relation_network_model, device)
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    export(feature_encoder, relation_network, args.input_dim, args.output_dir,
+           not args.no_onnx, args.opset)
+    print("exported to %s" % args.output_dir)
+    deviations = compare(args.output_dir, args.feature_encoder_model, args.relation_network_model, args.input_dim)
+    for running_stats, name in ((False, 'default (input statistics)'), (True, 'running_stats=True')):
+        difference, mask_difference = deviations[running_stats]
+        print("vs FewShotSegmenter %s: max probability difference %.4f, %.2f%% of mask pixels differ" % (
+            name, difference, 100 * mask_difference))
+    print("the graphs normalize with the stored batch norm statistics, like running_stats=True")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""Compact storage of predicted masks.
+
+    archive = MaskArchive('result1/masks.pkb')
+    archive.append('0001.jpg', mask)
+    mask = MaskArchive('result1/masks.pkb', 'r')['0001.jpg']
+
+Masks are boolean (H, W) arrays. pack_mask() stores 1 bit per pixel,
+rle_encode() the run lengths in the uncompressed RLE layout of COCO
+annotations. MaskArchive appends bit-packed masks to a single file with a
+JSON lines index, RLEWriter appends RLEs to a single JSON lines file, so
+millions of masks do not take millions of files.
+"""
+import os
+import json
+import threading
+import numpy as np
+
+
+def pack_mask(mask):
+    """{'bits', 'shape'} arrays of a boolean mask, for np.savez."""
+    return {'bits': np.packbits(mask, axis=None), 'shape': np.array(mask.shape)}
+
+
+def unpack_mask(bits, shape):
+    height, width = shape
+    return np.unpackbits(bits, count=height * width).reshape(height, width).astype(bool)
+
+
+def rle_encode(mask):
+    """COCO-style uncompressed RLE {'size': [H, W], 'counts': [...]} of a boolean mask.
+
+    Runs are counted in column-major order and alternate between background
+    and foreground, starting with background (so the first count may be 0).
+    """
+    flat = np.asarray(mask, dtype=bool).ravel(order='F')
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [flat.size])))
+    if flat.size and flat[0]:
+        counts = np.concatenate(([0], counts))
+    return {'size': list(mask.shape), 'counts': counts.tolist()}
+
+
+def rle_decode(rle):
+    height, width = rle['size']
+    counts = np.asarray(rle['counts'], dtype=np.int64)
+    values = np.arange(len(counts)) % 2 == 1
+    return np.repeat(values, counts).reshape((height, width), order='F')
+
+
+def read_index(path):
+    """Entries of a JSON lines index by name, later entries replace earlier ones.
+
+    A last line cut short by a crash is ignored.
+    """
+    entries = {}
+    if not os.path.exists(path):
+        return entries
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            entries[entry['name']] = entry
+    return entries
+
+
+class MaskArchive(object):
+    """Bit-packed masks appended to one data file, with an index for random reads.
+
+    `path` holds the packed masks back to back and `path`.idx a JSON line
+    per mask with its name, shape, offset and length. Opening an existing
+    archive appends to it; a mask appended again under the same name
+    replaces the earlier one. append() is thread-safe.
+    """
+
+    def __init__(self, path, mode='a'):
+        if mode not in ('a', 'r'):
+            raise Exception('MaskArchive mode must be a or r, got %s' % mode)
+        self.path = path
+        self.index_path = path + '.idx'
+        self.index = read_index(self.index_path)
+        self.lock = threading.Lock()
+        self.data = self.index_file = None
+        if mode == 'a':
+            self.data = open(path, 'ab')
+            self.index_file = open(self.index_path, 'a')
+        self.reader = open(path, 'rb') if os.path.exists(path) else None
+
+    def append(self, name, mask):
+        bits = np.packbits(mask, axis=None).tobytes()
+        with self.lock:
+            # the data is written before its index line, an entry never points past the data
+            offset = self.data.tell()
+            self.data.write(bits)
+            self.data.flush()
+            entry = {'name': name, 'shape': list(mask.shape), 'offset': offset, 'length': len(bits)}
+            self.index_file.write(json.dumps(entry) + '\n')
+            self.index_file.flush()
+            self.index[name] = entry
+
+    def __getitem__(self, name):
+        entry = self.index[name]
+        with self.lock:
+            if self.reader is None:
+                self.reader = open(self.path, 'rb')
+            self.reader.seek(entry['offset'])
+            bits = np.frombuffer(self.reader.read(entry['length']), dtype=np.uint8)
+        return unpack_mask(bits, entry['shape'])
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def names(self):
+        return sorted(self.index)
+
+    def close(self):
+        for f in (self.data, self.index_file, self.reader):
+            if f is not None:
+                f.close()
+
+
+class RLEWriter(object):
+    """RLEs of masks appended as JSON lines {"name", "size", "counts"} to one file.
+
+    Read them back with read_index(). append() is thread-safe.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def append(self, name, mask):
+        line = json.dumps(dict(rle_encode(mask), name=name)) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,80 @@
+"""Training throughput metrics.
+
+PhaseTimer accumulates the wall time of the phases of training, labelled
+for torch.profiler so the same phases show up in profiler traces.
+MetricsWriter appends records as JSON lines, one file can collect many runs
+for charting regressions.
+"""
+import json
+import time
+import contextlib
+import collections
+import torch
+
+
+class PhaseTimer(object):
+    """Wall time per named phase since the last reset().
+
+    On CUDA the device is synchronized around each phase, otherwise the time
+    of asynchronous kernels lands in whichever phase waits for them next.
+    With `labels`, by default when `enabled`, phases are labelled for
+    torch.profiler even when they are not timed.
+    """
+
+    def __init__(self, device=None, enabled=True, labels=None):
+        self.device = device
+        self.enabled = enabled
+        self.labels = enabled if labels is None else labels
+        self.sync = enabled and device is not None and device.type == 'cuda'
+        self.seconds = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        label = torch.profiler.record_function(name) if self.labels else contextlib.nullcontext()
+        if not self.enabled:
+            with label:
+                yield
+            return
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        start = time.perf_counter()
+        with label:
+            yield
+            if self.sync:
+                torch.cuda.synchronize(self.device)
+        self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+
+    def iterate(self, iterable, name):
+        """Items of `iterable`, timing the wait for each one as phase `name`."""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def reset(self):
+        """Seconds per phase since the last reset."""
+        seconds = dict(self.seconds)
+        self.seconds.clear()
+        return seconds
+
+
+class MetricsWriter(object):
+    """Append records to the JSONL file at `path`, does nothing if `path` is empty."""
+
+    def __init__(self, path):
+        self.file = open(path, 'a') if path else None
+
+    def write(self, record):
+        if self.file is None:
+            return
+        record = dict(record, time=time.time())
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
@@ -0,0 +1,250 @@
+"""Relation network for few-shot segmentation.
+
+CNNEncoder is VGG16-bn with a 4-channel input (RGB plus the support label,
+left at zero for queries) that also returns the skip features used by the
+RelationNetwork decoder.
+
+The networks were trained, and are released, to run with batch norm in
+train mode: each input is normalized with its own statistics, never with
+the running statistics stored in the checkpoints. use_batch_statistics()
+keeps that behaviour for inference without updating those statistics.
+"""
+import math
+import threading
+import contextlib
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# torchvision's VGG16 configuration, channels of each 3x3 convolution or M for max pooling
+VGG16 = [64, 64, 'M', 128, 128, 'M', 256, 256, 256, 'M', 512, 512, 512, 'M', 512, 512, 512, 'M']
+
+
+def vgg16_bn_features():
+    """The layers of torchvision's vgg16_bn().features, without building the classifier.
+
+    They are initialized as torchvision initializes them.
+    """
+    layers = []
+    in_channels = 3
+    for v in VGG16:
+        if v == 'M':
+            layers.append(nn.MaxPool2d(kernel_size=2, stride=2))
+        else:
+            conv = nn.Conv2d(in_channels, v, kernel_size=3, padding=1)
+            nn.init.kaiming_normal_(conv.weight, mode='fan_out', nonlinearity='relu')
+            nn.init.constant_(conv.bias, 0)
+            batch_norm = nn.BatchNorm2d(v)
+            nn.init.constant_(batch_norm.weight, 1)
+            nn.init.constant_(batch_norm.bias, 0)
+            layers += [conv, batch_norm, nn.ReLU(inplace=True)]
+            in_channels = v
+    return layers
+
+
+class CNNEncoder(nn.Module):
+    """VGG16-bn features, returning the last feature map and five skip features.
+
+    The layers are built directly, torchvision is only imported for the
+    ImageNet weights. Module names match torchvision's, so state dicts
+    saved from either load into the other.
+    """
+
+    def __init__(self, pretrained=False):
+        super(CNNEncoder, self).__init__()
+        if pretrained:
+            import torchvision.models as models
+            features = list(models.vgg16_bn(pretrained=True).features)
+        else:
+            features = vgg16_bn_features()
+        self.layer1 = nn.Sequential(
+            nn.Conv2d(4, 64, kernel_size=3, padding=1)
+        )
+        self.features = nn.ModuleList(features)[1:]  # .eval()
+        # print (nn.Sequential(*list(models.vgg16_bn(pretrained=True).children())[0]))
+        # self.features = nn.ModuleList(features).eval()
+
+    def forward(self, x):
+        results = []
+        x = self.layer1(x)
+        for ii, model in enumerate(self.features):
+            x = model(x)
+            if ii in {4, 11, 21, 31, 41}:
+                results.append(x)
+
+        return x, results
+
+
+class RelationNetwork(nn.Module):
+    """Decode a (support, query) feature pair into a foreground probability map."""
+
+    def __init__(self):
+        super(RelationNetwork, self).__init__()
+        self.layer1 = nn.Sequential(
+            nn.Conv2d(1024, 512, kernel_size=3, padding=1),
+            nn.BatchNorm2d(512, momentum=1, affine=True),
+            nn.ReLU()
+        )
+        self.layer2 = nn.Sequential(
+            nn.Conv2d(512, 512, kernel_size=3, padding=1),
+            nn.BatchNorm2d(512, momentum=1, affine=True),
+            nn.ReLU()
+        )
+        self.upsample = nn.Upsample(
+            scale_factor=2, mode='bilinear', align_corners=True)
+        self.double_conv1 = nn.Sequential(
+            nn.Conv2d(1024, 512, kernel_size=3, padding=1),
+            nn.BatchNorm2d(512, momentum=1, affine=True),
+            nn.ReLU(),
+            nn.Conv2d(512, 512, kernel_size=3, padding=1),
+            nn.BatchNorm2d(512, momentum=1, affine=True),
+            nn.ReLU()
+        )  # 14 x 14
+        self.double_conv2 = nn.Sequential(
+            nn.Conv2d(1024, 256, kernel_size=3, padding=1),
+            nn.BatchNorm2d(256, momentum=1, affine=True),
+            nn.ReLU(),
+            nn.Conv2d(256, 256, kernel_size=3, padding=1),
+            nn.BatchNorm2d(256, momentum=1, affine=True),
+            nn.ReLU()
+        )  # 28 x 28
+        self.double_conv3 = nn.Sequential(
+            nn.Conv2d(512, 128, kernel_size=3, padding=1),
+            nn.BatchNorm2d(128, momentum=1, affine=True),
+            nn.ReLU(),
+            nn.Conv2d(128, 128, kernel_size=3, padding=1),
+            nn.BatchNorm2d(128, momentum=1, affine=True),
+            nn.ReLU()
+        )  # 56 x 56
+        self.double_conv4 = nn.Sequential(
+            nn.Conv2d(256, 64, kernel_size=3, padding=1),
+            nn.BatchNorm2d(64, momentum=1, affine=True),
+            nn.ReLU(),
+            nn.Conv2d(64, 64, kernel_size=3, padding=1),
+            nn.BatchNorm2d(64, momentum=1, affine=True),
+            nn.ReLU()
+        )  # 112 x 112
+        self.double_conv5 = nn.Sequential(
+            nn.Conv2d(128, 64, kernel_size=3, padding=1),
+            nn.BatchNorm2d(64, momentum=1, affine=True),
+            nn.ReLU(),
+            nn.Conv2d(64, 1, kernel_size=1, padding=0),
+        )  # 256 x 256
+
+    def forward(self, x, concat_features):
+        out = self.layer1(x)
+        out = self.layer2(out)
+        out = self.upsample(out)  # block 1
+        out = torch.cat((out, concat_features[-1]), dim=1)
+        out = self.double_conv1(out)
+        out = self.upsample(out)  # block 2
+        out = torch.cat((out, concat_features[-2]), dim=1)
+        out = self.double_conv2(out)
+        out = self.upsample(out)  # block 3
+        out = torch.cat((out, concat_features[-3]), dim=1)
+        out = self.double_conv3(out)
+        out = self.upsample(out)  # block 4
+        out = torch.cat((out, concat_features[-4]), dim=1)
+        out = self.double_conv4(out)
+        out = self.upsample(out)  # block 5
+        out = torch.cat((out, concat_features[-5]), dim=1)
+        out = self.double_conv5(out)
+
+        out = torch.sigmoid(out)
+        return out
+
+    def forward_ways(self, sample_features, batch_features, concat_features):
+        """Probabilities (B, N, H, W) of B queries against N support prototypes.
+
+        Same result as forward() on all B*N (prototype, query) pairs, but
+        every convolution over a concatenation is split in two, so the
+        query features and skip features are convolved once per query and
+        broadcast over the ways instead of being copied for each of them.
+        """
+        batch, ways = batch_features.size(0), sample_features.size(0)
+        sample_out, batch_out = split_conv(self.layer1[0], sample_features, batch_features)
+        out = (sample_out.unsqueeze(0) + batch_out.unsqueeze(1)).flatten(0, 1)
+        out = self.layer1[1:](out)
+        out = self.layer2(out)
+        blocks = (self.double_conv1, self.double_conv2, self.double_conv3,
+                  self.double_conv4, self.double_conv5)
+        for block, skip in zip(blocks, reversed(concat_features)):
+            out = self.upsample(out)
+            pair_out, skip_out = split_conv(block[0], out, skip)
+            out = (pair_out.view(batch, ways, *pair_out.size()[1:]) + skip_out.unsqueeze(1)).flatten(0, 1)
+            out = block[1:](out)
+
+        out = torch.sigmoid(out)
+        return out.view(batch, ways, *out.size()[2:])
+
+
+class BatchStatNorm2d(nn.Module):
+    """A trained BatchNorm2d normalizing with the statistics of its input, as in train mode.
+
+    Each image is normalized on its own, so its output does not depend on
+    the other images of its batch, or inside shared_statistics() with the
+    statistics of the whole batch. The running statistics are neither used
+    nor updated.
+    """
+
+    def __init__(self, batch_norm):
+        super(BatchStatNorm2d, self).__init__()
+        self.weight = batch_norm.weight
+        self.bias = batch_norm.bias
+        self.eps = batch_norm.eps
+
+    def forward(self, x):
+        if getattr(_statistics, 'shared', False):
+            return F.batch_norm(x, None, None, self.weight, self.bias, True, 0.0, self.eps)
+        return F.instance_norm(x, None, None, self.weight, self.bias, True, 0.0, self.eps)
+
+
+_statistics = threading.local()
+
+
+@contextlib.contextmanager
+def shared_statistics():
+    """Within the block, BatchStatNorm2d layers run by this thread normalize over the whole batch.
+
+    Used to encode a support set, whose images were normalized together.
+    """
+    _statistics.shared = True
+    try:
+        yield
+    finally:
+        _statistics.shared = False
+
+
+def use_batch_statistics(network):
+    """Replace the BatchNorm2d layers of `network` by BatchStatNorm2d in place, returns `network`."""
+    for name, module in list(network.named_modules()):
+        if isinstance(module, nn.BatchNorm2d):
+            parent, _, child = name.rpartition('.')
+            setattr(network.get_submodule(parent) if parent else network, child, BatchStatNorm2d(module))
+    return network
+
+
+def split_conv(conv, x, y):
+    """conv(torch.cat((x, y), 1)) as its two halves, the bias added to the first.
+
+    Each half can then be computed on its own batch and the two broadcast.
+    """
+    channels = x.size(1)
+    return (F.conv2d(x, conv.weight[:, :channels], conv.bias, conv.stride, conv.padding),
+            F.conv2d(y, conv.weight[:, channels:], None, conv.stride, conv.padding))
+
+
+def weights_init(m):
+    classname = m.__class__.__name__
+    if classname.find('Conv') != -1:
+        n = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
+        m.weight.data.normal_(0, math.sqrt(2. / n))
+        if m.bias is not None:
+            m.bias.data.zero_()
+    elif classname.find('BatchNorm') != -1:
+        m.weight.data.fill_(1)
+        m.bias.data.zero_()
+    elif classname.find('Linear') != -1:
+        n = m.weight.size(1)
+        m.weight.data.normal_(0, 0.01)
+        m.bias.data = torch.ones(m.bias.data.size())
@@ -0,0 +1,115 @@
+"""Data-parallel training over torch.distributed processes.
+
+    python train.py -np 4                       # 4 local processes
+    torchrun --nnodes 2 --nproc_per_node 4 --rdzv_endpoint host:29500 train.py
+
+Every rank trains the same networks on its own episodes. Gradients are
+averaged across ranks after each backward pass, so the networks stay in
+sync and each step trains on world_size episodes. The default gloo backend
+runs on CPU-only machines.
+"""
+import os
+import socket
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def init_distributed(backend='gloo'):
+    """Join the process group described by the environment, returns (rank, world_size).
+
+    The environment is set by torchrun or launch(); without it this is a
+    single process, (0, 1).
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size > 1 and not dist.is_initialized():
+        dist.init_process_group(backend)
+    return get_rank(), world_size
+
+
+def get_rank():
+    return dist.get_rank() if dist.is_initialized() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+
+def is_main():
+    """True on the rank that logs and saves checkpoints."""
+    return get_rank() == 0
+
+
+def local_rank():
+    return int(os.environ.get('LOCAL_RANK', 0))
+
+
+def default_threads():
+    """CPU threads per process when the local processes share the cores, 0 for a single process."""
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    if local_world_size <= 1:
+        return 0
+    return max(1, (os.cpu_count() or 1) // local_world_size)
+
+
+def broadcast_networks(networks):
+    """Copy the parameters and buffers of rank 0's networks to every rank."""
+    if get_world_size() == 1:
+        return
+    with torch.no_grad():
+        for network in networks:
+            for tensor in list(network.parameters()) + list(network.buffers()):
+                dist.broadcast(tensor.data, 0)
+
+
+def average_gradients(networks):
+    """Average the gradients of `networks` across ranks with one all-reduce."""
+    world_size = get_world_size()
+    if world_size == 1:
+        return
+    grads = [p.grad for network in networks for p in network.parameters() if p.grad is not None]
+    flat = torch.cat([grad.flatten() for grad in grads])
+    dist.all_reduce(flat)
+    flat /= world_size
+    offset = 0
+    for grad in grads:
+        grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+        offset += grad.numel()
+
+
+def broadcast_int(value):
+    """Rank 0's integer on every rank, e.g. a seed or a flag to stop all ranks together."""
+    if get_world_size() == 1:
+        return value
+    tensor = torch.tensor([int(value)], dtype=torch.int64)
+    dist.broadcast(tensor, 0)
+    return int(tensor.item())
+
+
+def barrier():
+    if get_world_size() > 1:
+        dist.barrier()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def launch(fn, num_procs, args=(), backend='gloo'):
+    """Run fn(*args) in `num_procs` local processes joined in one process group."""
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(free_port())
+    mp.spawn(_run, args=(fn, num_procs, backend, args), nprocs=num_procs)
+
+
+def _run(rank, fn, num_procs, backend, args):
+    os.environ.update({'RANK': str(rank), 'LOCAL_RANK': str(rank),
+                       'WORLD_SIZE': str(num_procs), 'LOCAL_WORLD_SIZE': str(num_procs)})
+    init_distributed(backend)
+    try:
+        fn(*args)
+    finally:
+        if dist.is_initialized():
+            dist.destroy_process_group()
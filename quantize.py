@@ -0,0 +1,146 @@
+"""Post-training int8 quantization of the networks for CPU inference.
+
+    python quantize.py -dr support -o models/int8 -ts fss_test_set.txt
+    python autolabel.py -modelf models/int8/feature_encoder.pt \
+        -modelr models/int8/relation_network.pt -dev cpu -sd ... -td ...
+
+Both networks are statically quantized in FX graph mode: BatchNorm is folded
+into the convolutions and activation ranges are calibrated on episodes
+sampled from the dataset in -dr (laid out as described in dataset.py). The
+quantized networks are saved as TorchScript, which FewShotSegmenter loads
+in place of a state dict. Dynamic quantization is no alternative here, it
+only covers Linear and recurrent layers and these networks are convolutional.
+
+With -ts, the float and int8 networks are then compared on the listed test
+classes: per-image latency and mean IoU of each.
+"""
+import os
+import copy
+import random
+import argparse
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from network import CNNEncoder, RelationNetwork
+from dataset import EpisodeSampler
+from evaluate import evaluate, read_test_set
+from device import set_threads
+from segmenter import FewShotSegmenter, load_network
+
+
+class FlatRelation(nn.Module):
+    """RelationNetwork taking the five skip features as separate arguments.
+
+    FX quantization only observes tensor arguments, not tensors in a list.
+    """
+
+    def __init__(self, relation_network):
+        super(FlatRelation, self).__init__()
+        self.relation_network = relation_network
+
+    def forward(self, x, f1, f2, f3, f4, f5):
+        return self.relation_network(x, [f1, f2, f3, f4, f5])
+
+
+class ListRelation(nn.Module):
+    """Quantized FlatRelation behind RelationNetwork's (x, concat_features) signature."""
+
+    def __init__(self, flat_relation):
+        super(ListRelation, self).__init__()
+        self.flat_relation = flat_relation
+
+    def forward(self, x, concat_features):
+        return self.flat_relation(x, *concat_features)
+
+
+def quantize(feature_encoder, relation_network, sampler, episodes, input_dim, backend='fbgemm', rng=random):
+    """Calibrate and convert float CPU networks, returns TorchScript int8 networks."""
+    torch.backends.quantized.engine = backend
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    size = input_dim // 32
+    example = torch.zeros(1, 4, input_dim, input_dim)
+    with torch.no_grad():
+        _, ft_list = feature_encoder(example)
+    pair_example = torch.zeros(1, 1024, size, size)
+
+    encoder = prepare_fx(copy.deepcopy(feature_encoder).eval(), qconfig_mapping, (example,))
+    relation = prepare_fx(FlatRelation(copy.deepcopy(relation_network)).eval(), qconfig_mapping,
+                          (pair_example,) + tuple(ft_list))
+    with torch.no_grad():
+        for episode in range(episodes):
+            samples, _, batches, _, _ = sampler.sample(rng)
+            sample_features, _ = encoder(samples)
+            prototype = torch.sum(sample_features, 0, keepdim=True)
+            batch_features, ft_list = encoder(batches)
+            relation(torch.cat((prototype.expand_as(batch_features), batch_features), 1), *ft_list)
+    encoder = convert_fx(encoder)
+    relation = ListRelation(convert_fx(relation)).eval()
+
+    with torch.no_grad():
+        encoder = torch.jit.trace(encoder, example, check_trace=False, strict=False)
+        relation = torch.jit.trace(relation, (pair_example, ft_list), check_trace=False, strict=False)
+    return encoder, relation
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Post-training int8 quantization")
+    parser.add_argument("-i", "--input_dim", type=int, default=224)
+    parser.add_argument("-s", "--sample_num_per_class", type=int, default=5)
+    parser.add_argument("-b", "--batch_num_per_class", type=int, default=5)
+    parser.add_argument("-modelf", "--feature_encoder_model", type=str, default='models/feature_encoder.pkl')
+    parser.add_argument("-modelr", "--relation_network_model", type=str, default='models/relation_network.pkl')
+    parser.add_argument("-dr", "--data_dir", type=str, default='support')
+    parser.add_argument("-ce", "--calibration_episodes", type=int, default=16)
+    parser.add_argument("-o", "--output_dir", type=str, default='models/int8')
+    parser.add_argument("-ts", "--test_set", type=str, default='')
+    parser.add_argument("--backend", type=str, default='fbgemm', choices=['fbgemm', 'x86', 'qnnpack'])
+    parser.add_argument("-nt", "--num_threads", type=int, default=0)
+    parser.add_argument("-seed", "--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    set_threads(args.num_threads)
+    torch.manual_seed(args.seed)
+    device = torch.device('cpu')
+    feature_encoder = load_network(CNNEncoder, args.feature_encoder_model, device)
+    relation_network = load_network(RelationNetwork, args.relation_network_model, device)
+
+    print("calibrating on %d episodes" % args.calibration_episodes)
+    sampler = EpisodeSampler(args.data_dir, args.input_dim, 1, args.sample_num_per_class,
+                             args.batch_num_per_class)
+    encoder, relation = quantize(feature_encoder, relation_network, sampler, args.calibration_episodes,
+                                 args.input_dim, args.backend, random.Random(args.seed))
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    feature_path = '%s/feature_encoder.pt' % args.output_dir
+    relation_path = '%s/relation_network.pt' % args.output_dir
+    torch.jit.save(encoder, feature_path)
+    torch.jit.save(relation, relation_path)
+    print("saved %s and %s" % (feature_path, relation_path))
+
+    if args.test_set:
+        classes = read_test_set(args.test_set)
+        sampler = EpisodeSampler(args.data_dir, args.input_dim, 1, args.sample_num_per_class, 0)
+        reports = {}
+        # fp32 as autolabel.py, evaluate.py and server.py run it by default, the reference;
+        # fp32_running_stats normalizes with the stored statistics, as the int8 graphs do
+        for name, paths, running_stats in (
+                ('fp32', (args.feature_encoder_model, args.relation_network_model), False),
+                ('fp32_running_stats', (args.feature_encoder_model, args.relation_network_model), True),
+                ('int8', (feature_path, relation_path), False)):
+            segmenter = FewShotSegmenter(paths[0], paths[1], args.input_dim, device, running_stats=running_stats)
+            # one query per forward pass, so the latency is per image
+            reports[name] = evaluate(segmenter, sampler, classes, args.sample_num_per_class,
+                                     batch_size=1, seed=args.seed)
+            print("%s: mean IoU %.4f, latency %.1fms mean / %.1fms median over %d images" % (
+                name, reports[name]['mean_iou'], reports[name]['latency_ms_per_image']['mean'],
+                reports[name]['latency_ms_per_image']['p50'], reports[name]['images']))
+        print("IoU drift %+.4f, speedup %.2fx" % (
+            reports['int8']['mean_iou'] - reports['fp32']['mean_iou'],
+            reports['fp32']['latency_ms_per_image']['mean'] / reports['int8']['latency_ms_per_image']['mean']))
+        print("IoU drift against fp32 with running statistics %+.4f" % (
+            reports['int8']['mean_iou'] - reports['fp32_running_stats']['mean_iou']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""Registry of encoded support sets for serving many classes.
+
+Each support set is stored as its prototype, the summed CNNEncoder feature
+that FewShotSegmenter.forward() pairs with every query, so switching between
+classes is a lookup instead of a support-set encoding.
+"""
+import os
+import hashlib
+import threading
+import collections
+from concurrent.futures import Future
+import torch
+
+
+class SupportRegistry(object):
+    """Support prototypes by id with least-recently-used eviction.
+
+    Prototypes are kept in memory up to `max_bytes`. Evicted prototypes are
+    written to `spill_dir` when it is set and read back on their next lookup.
+    A lookup missing both is passed to `loader(support_id)`, which may encode
+    the support set again or return None for unknown ids. Concurrent
+    lookups of an id being loaded wait for that load instead of calling
+    `loader` again.
+    """
+
+    def __init__(self, max_bytes=256 * 2 ** 20, spill_dir='', loader=None, device='cpu'):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.loader = loader
+        self.device = device
+        self.entries = collections.OrderedDict()
+        self.spilled = set()
+        # Future of each id whose loader() call is running
+        self.loading = {}
+        self.nbytes = 0
+        self.counters = {'hits': 0, 'spill_hits': 0, 'misses': 0, 'load_waits': 0, 'evictions': 0}
+        self.lock = threading.Lock()
+        if spill_dir and not os.path.exists(spill_dir):
+            os.makedirs(spill_dir)
+
+    def spill_path(self, support_id):
+        return '%s/%s.pt' % (self.spill_dir, hashlib.sha1(support_id.encode('utf-8')).hexdigest())
+
+    def put(self, support_id, prototype):
+        with self.lock:
+            self._remove(support_id)
+            if support_id in self.spilled:
+                self.spilled.discard(support_id)
+                os.remove(self.spill_path(support_id))
+            self.entries[support_id] = prototype
+            self.nbytes += prototype.element_size() * prototype.nelement()
+            self._evict()
+
+    def get(self, support_id):
+        """Prototype of a support set, None if it is unknown."""
+        with self.lock:
+            if support_id in self.entries:
+                self.counters['hits'] += 1
+                self.entries.move_to_end(support_id)
+                return self.entries[support_id]
+            if support_id in self.spilled:
+                self.counters['spill_hits'] += 1
+                prototype = torch.load(self.spill_path(support_id), map_location=self.device)
+                self.entries[support_id] = prototype
+                self.nbytes += prototype.element_size() * prototype.nelement()
+                self._evict(keep=support_id)
+                return prototype
+            future = self.loading.get(support_id)
+            if future is not None:
+                self.counters['load_waits'] += 1
+            else:
+                self.counters['misses'] += 1
+                self.loading[support_id] = Future()
+        if future is not None:
+            return future.result()
+        # encoding is slow, do not block other lookups meanwhile
+        try:
+            prototype = self.loader(support_id) if self.loader is not None else None
+            if prototype is not None:
+                self.put(support_id, prototype)
+        except Exception as e:
+            with self.lock:
+                future = self.loading.pop(support_id)
+            future.set_exception(e)
+            raise
+        with self.lock:
+            future = self.loading.pop(support_id)
+        future.set_result(prototype)
+        return prototype
+
+    def __contains__(self, support_id):
+        with self.lock:
+            return support_id in self.entries or support_id in self.spilled
+
+    def ids(self):
+        with self.lock:
+            return sorted(set(self.entries) | self.spilled)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update({'in_memory': len(self.entries), 'spilled': len(self.spilled),
+                          'bytes': self.nbytes, 'max_bytes': self.max_bytes})
+            return stats
+
+    def _remove(self, support_id):
+        prototype = self.entries.pop(support_id, None)
+        if prototype is not None:
+            self.nbytes -= prototype.element_size() * prototype.nelement()
+        return prototype
+
+    def _evict(self, keep=None):
+        while self.nbytes > self.max_bytes and self.entries:
+            support_id = next(iter(self.entries))
+            if support_id == keep and len(self.entries) == 1:
+                break
+            if support_id == keep:
+                self.entries.move_to_end(support_id)
+                continue
+            prototype = self._remove(support_id)
+            self.counters['evictions'] += 1
+            if self.spill_dir and support_id not in self.spilled:
+                torch.save(prototype.cpu(), self.spill_path(support_id))
+                self.spilled.add(support_id)
@@ -0,0 +1,311 @@
+"""In-process few-shot segmentation engine.
+
+    segmenter = FewShotSegmenter('models/feature_encoder.pkl',
+                                 'models/relation_network.pkl')
+    segmenter.set_support(support_images, support_masks)
+    masks = segmenter.predict(query_images)
+
+Images are RGB uint8 arrays of shape (H, W, 3), masks uint8 arrays of shape
+(H, W) with the values of the FSS-1000 label files (0 background, 255
+foreground). Weights are loaded once; the support set is encoded once per
+set_support() call and shared by every following predict().
+
+As during training, batch norm normalizes the support set with the
+statistics of its images and each query with its own, so a mask does not
+depend on the other queries of its batch. running_stats=True uses the
+statistics stored in the checkpoints instead, as exported and quantized
+graphs do.
+"""
+import os
+import json
+import zipfile
+import numpy as np
+import cv2
+import torch
+
+from device import get_device
+from support import support_files
+from network import CNNEncoder, RelationNetwork, shared_statistics, use_batch_statistics
+
+
+def read_support(support_dir, shots=5):
+    """RGB images and label masks of a support directory, for set_support()."""
+    images, masks = [], []
+    for imgname, labelname in support_files(support_dir, shots):
+        image = cv2.imread('%s/image/%s' % (support_dir, imgname))
+        label = cv2.imread('%s/label/%s' % (support_dir, labelname))
+        if image is None or label is None:
+            raise Exception('cannot load support image %s/image/%s' % (support_dir, imgname))
+        images.append(np.ascontiguousarray(image[:, :, ::-1]))  # bgr to rgb
+        masks.append(label[:, :, 0])
+    return images, masks
+
+
+def is_torchscript(path):
+    """Whether `path` is a TorchScript archive rather than a state dict."""
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as archive:
+        return any('/code/' in name for name in archive.namelist())
+
+
+def load_state_dict(path, device):
+    """torch.load of a state dict, memory-mapped when the file allows it.
+
+    Memory-mapped weights are paged in as they are used instead of being
+    read and copied up front. Files in the legacy (non-zip) format and
+    torch < 2.1 fall back to a plain load.
+    """
+    try:
+        return torch.load(path, map_location=device, mmap=True)
+    except (TypeError, RuntimeError):
+        return torch.load(path, map_location=device)
+
+
+def load_network(network_class, path, device):
+    """A network in eval mode from a state dict or a TorchScript export (e.g. quantize.py's)."""
+    if not os.path.exists(path):
+        raise Exception('Can not load %s: %s' % (network_class.__name__, path))
+    if is_torchscript(path):
+        network = torch.jit.load(path, map_location=device)
+    else:
+        state_dict = load_state_dict(path, device)
+        try:
+            # built without initializing the weights the state dict replaces
+            with torch.device('meta'):
+                network = network_class()
+            network.load_state_dict(state_dict, assign=True)
+        except (AttributeError, TypeError):
+            # torch < 2.1
+            network = network_class()
+            network.load_state_dict(state_dict)
+        network.to(device)
+    network.eval()
+    return network
+
+
+def batch_statistics(network):
+    """`network` with batch norm normalizing by input statistics, TorchScript graphs are returned as is."""
+    if isinstance(network, torch.jit.ScriptModule):
+        return network
+    return use_batch_statistics(network)
+
+
+def tile_origins(length, tile, stride):
+    """Start offsets of tiles covering [0, length), the last one ending at `length`."""
+    origins = list(range(0, max(length - tile, 0) + 1, stride))
+    if origins[-1] + tile < length:
+        origins.append(length - tile)
+    return origins
+
+
+def blend_window(tile, overlap):
+    """(tile, tile) weights for blending overlapping tiles, ramping down over `overlap` pixels at the borders."""
+    ramp = np.minimum(np.arange(1, tile + 1), np.arange(tile, 0, -1))
+    ramp = np.minimum(ramp, max(overlap, 1)).astype(np.float32)
+    return np.outer(ramp, ramp)
+
+
+class FewShotSegmenter(object):
+    """Segment query images against a support set with a trained relation network."""
+
+    def __init__(self, feature_model, relation_model, input_dim=224, device='auto', gpu=0, batch_size=8,
+                 running_stats=False):
+        assert (input_dim % 224 == 0)
+        self.input_dim = input_dim
+        self.batch_size = batch_size
+        self.device = get_device(device, gpu) if isinstance(device, str) else device
+        self.feature_encoder = load_network(CNNEncoder, feature_model, self.device)
+        self.relation_network = load_network(RelationNetwork, relation_model, self.device)
+        if not running_stats:
+            self.feature_encoder = batch_statistics(self.feature_encoder)
+            self.relation_network = batch_statistics(self.relation_network)
+        self.prototype = None
+
+    @classmethod
+    def from_networks(cls, feature_encoder, relation_network, input_dim=224, device='cpu', batch_size=8,
+                      running_stats=False):
+        """Segmenter around networks already in memory, e.g. during training.
+
+        Unless `running_stats`, the batch norm layers of the networks are
+        replaced in place, pass copies of networks that are still trained.
+        """
+        segmenter = cls.__new__(cls)
+        segmenter.input_dim = input_dim
+        segmenter.batch_size = batch_size
+        segmenter.device = torch.device(device)
+        if not running_stats:
+            feature_encoder = batch_statistics(feature_encoder)
+            relation_network = batch_statistics(relation_network)
+        segmenter.feature_encoder = feature_encoder
+        segmenter.relation_network = relation_network
+        segmenter.prototype = None
+        return segmenter
+
+    def preprocess(self, images, labels=None):
+        """Stack images (and support labels) into a (N, 4, input_dim, input_dim) float32 tensor."""
+        input_dim = self.input_dim
+        tensor = np.zeros((len(images), 4, input_dim, input_dim), dtype=np.float32)
+        for i, image in enumerate(images):
+            image = np.ascontiguousarray(image)
+            if not image.shape[:2] == (input_dim, input_dim):
+                image = cv2.resize(image, (input_dim, input_dim))
+            tensor[i, 0:3] = np.transpose(image, (2, 0, 1))
+            if labels is not None:
+                label = labels[i]
+                if label.dtype == bool:
+                    label = label.astype(np.uint8) * 255
+                if not label.shape[:2] == (input_dim, input_dim):
+                    label = cv2.resize(label, (input_dim, input_dim), interpolation=cv2.INTER_NEAREST)
+                tensor[i, 3] = label
+        tensor[:, 0:3] /= 255.0
+        return torch.from_numpy(tensor)
+
+    def encode_support(self, samples):
+        """Summed encoder feature (1, 512, input_dim/32, input_dim/32) of a support tensor."""
+        with torch.no_grad(), shared_statistics():
+            sample_features, _ = self.feature_encoder(samples.to(self.device))
+            return torch.sum(sample_features, 0, keepdim=True)
+
+    def set_support(self, images, masks):
+        """Encode the support set used by the following predict() calls."""
+        if len(images) != len(masks) or len(images) == 0:
+            raise Exception('set_support needs one mask per image, got %d images and %d masks'
+                            % (len(images), len(masks)))
+        self.prototype = self.encode_support(self.preprocess(images, masks))
+        return self.prototype
+
+    def forward(self, batches, prototype=None):
+        """Foreground probabilities (N, 1, input_dim, input_dim) for a query tensor.
+
+        `prototype` is a single support prototype or one per query.
+        """
+        prototype = self.prototype if prototype is None else prototype
+        if prototype is None:
+            raise Exception('no support set, call set_support() first')
+        with torch.no_grad():
+            batch_features, ft_list = self.feature_encoder(batches.to(self.device))
+            if prototype.size(0) == 1 and hasattr(self.relation_network, 'forward_ways'):
+                return self.relation_network.forward_ways(prototype, batch_features, ft_list)
+            relation_pairs = torch.cat((prototype.expand_as(batch_features), batch_features), 1)
+            return self.relation_network(relation_pairs, ft_list)
+
+    def forward_ways(self, batches, prototypes):
+        """Probabilities (N, ways, input_dim, input_dim) of every query against every prototype.
+
+        Each query is encoded once whatever the number of ways.
+        """
+        with torch.no_grad():
+            batch_features, ft_list = self.feature_encoder(batches.to(self.device))
+            if hasattr(self.relation_network, 'forward_ways'):
+                return self.relation_network.forward_ways(prototypes, batch_features, ft_list)
+            # TorchScript networks only have forward(), pair every query with every way
+            batch, ways = batch_features.size(0), prototypes.size(0)
+            relation_pairs = torch.cat((prototypes.repeat(batch, 1, 1, 1),
+                                        batch_features.repeat_interleave(ways, 0)), 1)
+            ft_list = [ft.repeat_interleave(ways, 0) for ft in ft_list]
+            return self.relation_network(relation_pairs, ft_list).view(batch, ways, self.input_dim, self.input_dim)
+
+    def predict(self, queries, threshold=0.5):
+        """Masks (N, input_dim, input_dim) for a list or array of query images.
+
+        Masks are uint8 0/1, or float32 probabilities when `threshold` is None.
+        Queries are run `batch_size` at a time.
+        """
+        outputs = []
+        for i in range(0, len(queries), self.batch_size):
+            output = self.forward(self.preprocess(queries[i:i+self.batch_size]))[:, 0]
+            if threshold is not None:
+                output = output > threshold
+            outputs.append(output.cpu().numpy())
+        dtype = np.float32 if threshold is None else np.uint8
+        if not outputs:
+            return np.zeros((0, self.input_dim, self.input_dim), dtype=dtype)
+        return np.concatenate(outputs).astype(dtype, copy=False)
+
+    def predict_tiled(self, image, prototype=None, overlap=0.25, tile_batch_size=16, scale=1.0):
+        """Foreground probabilities (H, W) of one query image at its own resolution.
+
+        Instead of being resized to input_dim, the image (rescaled by `scale`
+        first) is cut into input_dim tiles overlapping by `overlap` of a tile.
+        Tiles run `tile_batch_size` per forward pass, which bounds memory, and
+        their outputs are blended with weights falling off towards the tile
+        borders so that seams do not show. Images smaller than a tile are
+        padded by replicating their border.
+        """
+        height, width = image.shape[:2]
+        if scale != 1.0:
+            image = cv2.resize(image, (max(1, int(round(width * scale))), max(1, int(round(height * scale)))),
+                               interpolation=cv2.INTER_AREA)
+        tile = self.input_dim
+        h, w = image.shape[:2]
+        if h < tile or w < tile:
+            image = cv2.copyMakeBorder(image, 0, max(tile - h, 0), 0, max(tile - w, 0), cv2.BORDER_REPLICATE)
+        stride = max(1, int(tile * (1 - overlap)))
+        origins = [(y, x) for y in tile_origins(image.shape[0], tile, stride)
+                   for x in tile_origins(image.shape[1], tile, stride)]
+        window = blend_window(tile, tile - stride)
+        image = np.transpose(image, (2, 0, 1))
+        probs = np.zeros(image.shape[1:], dtype=np.float32)
+        weights = np.zeros(image.shape[1:], dtype=np.float32)
+        for i in range(0, len(origins), tile_batch_size):
+            chunk = origins[i:i+tile_batch_size]
+            tiles = np.zeros((len(chunk), 4, tile, tile), dtype=np.float32)
+            for j, (y, x) in enumerate(chunk):
+                tiles[j, 0:3] = image[:, y:y+tile, x:x+tile]
+            tiles[:, 0:3] /= 255.0
+            output = self.forward(torch.from_numpy(tiles), prototype)[:, 0].float().cpu().numpy()
+            for j, (y, x) in enumerate(chunk):
+                probs[y:y+tile, x:x+tile] += output[j] * window
+                weights[y:y+tile, x:x+tile] += window
+        probs = (probs / weights)[:h, :w]
+        if (h, w) != (height, width):
+            probs = cv2.resize(probs, (width, height), interpolation=cv2.INTER_LINEAR)
+        return probs
+
+    def predict_ways(self, queries, prototypes):
+        """Probabilities (N, ways, input_dim, input_dim) of query images against several support sets.
+
+        `prototypes` stacks the set_support()/encode_support() results of
+        the candidate classes, e.g. to label one image against 20 classes.
+        """
+        prototypes = torch.cat(list(prototypes)) if isinstance(prototypes, (list, tuple)) else prototypes
+        outputs = [self.forward_ways(self.preprocess(queries[i:i+self.batch_size]), prototypes).cpu().numpy()
+                   for i in range(0, len(queries), self.batch_size)]
+        if not outputs:
+            return np.zeros((0, prototypes.size(0), self.input_dim, self.input_dim), dtype=np.float32)
+        return np.concatenate(outputs)
+
+
+class ExportedSegmenter(FewShotSegmenter):
+    """FewShotSegmenter running the graphs written by export.py.
+
+    The networks are not built: support encoding and the fused
+    encoder+relation forward are each a single TorchScript graph. Batch
+    norm is folded into the convolutions with its stored statistics, as
+    with running_stats=True.
+    """
+
+    def __init__(self, graph_dir, device='auto', gpu=0, batch_size=8):
+        with open('%s/export.json' % graph_dir) as f:
+            self.input_dim = json.load(f)['input_dim']
+        self.batch_size = batch_size
+        self.device = get_device(device, gpu) if isinstance(device, str) else device
+        self.support_graph = torch.jit.load('%s/support.pt' % graph_dir, map_location=self.device)
+        self.segment_graph = torch.jit.load('%s/segment.pt' % graph_dir, map_location=self.device)
+        self.prototype = None
+
+    def encode_support(self, samples):
+        with torch.no_grad():
+            return self.support_graph(samples.to(self.device))
+
+    def forward(self, batches, prototype=None):
+        prototype = self.prototype if prototype is None else prototype
+        if prototype is None:
+            raise Exception('no support set, call set_support() first')
+        with torch.no_grad():
+            return self.segment_graph(batches.to(self.device), prototype)
+
+    def forward_ways(self, batches, prototypes):
+        # the exported graph takes one prototype, so queries are encoded once per way
+        return torch.cat([self.forward(batches, prototype.unsqueeze(0)) for prototype in prototypes], 1)
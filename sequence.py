@@ -0,0 +1,52 @@
+"""Change detection for segmenting frame sequences.
+
+Consecutive video frames are often nearly identical. KeyframeSelector
+compares a small grayscale thumbnail of each frame with the one of the last
+keyframe, the last frame that went through the network. Frames that changed
+less than a threshold reuse the keyframe's mask instead of a forward pass.
+Comparing with the keyframe rather than the previous frame keeps a slow
+drift from being skipped forever.
+"""
+import numpy as np
+import cv2
+
+
+class KeyframeSelector(object):
+    """Decide which frames of a sequence to segment, in frame order.
+
+    `threshold` is the mean absolute difference of the (`size`, `size`)
+    thumbnails, in gray levels 0-255, from which a frame is a keyframe; 0
+    makes every frame a keyframe. After `max_reuse` reused frames in a row
+    the next frame is a keyframe anyway, 0 for no limit.
+    """
+
+    def __init__(self, threshold=2.0, size=32, max_reuse=30):
+        self.threshold = threshold
+        self.size = size
+        self.max_reuse = max_reuse
+        self.keyframe = None
+        self.reused = 0
+        self.frames = 0
+        self.keyframes = 0
+
+    def thumbnail(self, frame):
+        gray = cv2.cvtColor(np.ascontiguousarray(frame), cv2.COLOR_RGB2GRAY)
+        return cv2.resize(gray, (self.size, self.size), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    def is_keyframe(self, frame):
+        """Whether an RGB frame must be segmented, False if it can reuse the last keyframe's mask."""
+        self.frames += 1
+        thumbnail = self.thumbnail(frame)
+        if self.keyframe is None or (self.max_reuse and self.reused >= self.max_reuse) \
+                or np.mean(np.abs(thumbnail - self.keyframe)) >= self.threshold:
+            self.keyframe = thumbnail
+            self.reused = 0
+            self.keyframes += 1
+            return True
+        self.reused += 1
+        return False
+
+    def stats(self):
+        skipped = self.frames - self.keyframes
+        return {'frames': self.frames, 'forwards': self.keyframes, 'skipped': skipped,
+                'skipped_ratio': skipped / float(max(self.frames, 1))}
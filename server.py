@@ -0,0 +1,282 @@
+"""Resident segmentation server.
+
+Loads the networks once and serves masks over HTTP on a local TCP port or a
+Unix socket:
+
+    python server.py -ss example=imgs/example/support --port 8000
+    curl --data-binary @query.jpg http://localhost:8000/predict/example > mask.png
+
+Endpoints:
+
+    POST /predict/<support id>  body: encoded image, returns the mask as a PNG
+                                (0/255) at the size of the input image
+    POST /support/<support id>  body: JSON {"images": [...], "masks": [...]}
+                                with base64 encoded image files, registers a
+                                support set
+    GET  /stats                 JSON latency and batch size histograms and
+                                support registry counters
+
+Concurrent predict requests are grouped into micro-batches: a batch runs as
+soon as it has --max_batch queries or its oldest query has waited
+--max_latency_ms.
+
+Encoded support sets are kept in a SupportRegistry of --registry_mb
+megabytes. Sets given with -ss are encoded on first use and again after
+eviction; sets uploaded over HTTP are lost on eviction unless --spill_dir
+is set.
+"""
+import os
+import json
+import time
+import queue
+import base64
+import bisect
+import socket
+import argparse
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import cv2
+import torch
+
+from device import set_threads
+from segmenter import FewShotSegmenter, read_support
+from registry import SupportRegistry
+
+
+class Histogram(object):
+    """Thread-safe counts of observations; bucket i counts values <= bounds[i]."""
+
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.bounds, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def to_dict(self):
+        with self.lock:
+            buckets = ['<=%g' % bound for bound in self.bounds] + ['>%g' % self.bounds[-1]]
+            return {'count': self.count,
+                    'mean': self.sum / self.count if self.count else 0.0,
+                    'buckets': dict(zip(buckets, self.counts))}
+
+
+class MicroBatcher(object):
+    """Run queries from many request threads through the network in batches."""
+
+    def __init__(self, segmenter, max_batch, max_latency):
+        self.segmenter = segmenter
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        self.latency = Histogram([1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000])
+        self.batch_size = Histogram([2 ** i for i in range(max_batch.bit_length())])
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def predict(self, query, prototype):
+        """Foreground probabilities (input_dim, input_dim) of one preprocessed query."""
+        item = {'query': query, 'prototype': prototype, 'start': time.time(),
+                'done': threading.Event(), 'output': None, 'error': None}
+        self.queue.put(item)
+        item['done'].wait()
+        self.latency.add((time.time() - item['start']) * 1000)
+        if item['error'] is not None:
+            raise item['error']
+        return item['output']
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = batch[0]['start'] + self.max_latency
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self.batch_size.add(len(batch))
+            try:
+                # queries of different support sets share a batch, each is
+                # paired with its own prototype
+                output = self.segmenter.forward(torch.cat([item['query'] for item in batch]),
+                                                torch.cat([item['prototype'] for item in batch]))
+                output = output[:, 0].cpu().numpy()
+                for i, item in enumerate(batch):
+                    item['output'] = output[i]
+            except Exception as e:
+                for item in batch:
+                    item['error'] = e
+            for item in batch:
+                item['done'].set()
+
+
+class SegmentationHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/stats':
+            return self.send_json(404, {'error': 'unknown path %s' % self.path})
+        batcher = self.server.batcher
+        self.send_json(200, {'latency_ms': batcher.latency.to_dict(),
+                             'batch_size': batcher.batch_size.to_dict(),
+                             'support_registry': self.server.registry.stats(),
+                             'support_sets': sorted(set(self.server.registry.ids()) |
+                                                    set(self.server.support_dirs))})
+
+    def do_POST(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] not in ('predict', 'support'):
+            return self.send_json(404, {'error': 'unknown path %s' % self.path})
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if parts[0] == 'predict':
+            self.predict(parts[1], body)
+        else:
+            self.register(parts[1], body)
+
+    def predict(self, support_id, body):
+        prototype = self.server.registry.get(support_id)
+        if prototype is None:
+            return self.send_json(404, {'error': 'unknown support set %s' % support_id})
+        image = decode_image(body)
+        if image is None:
+            return self.send_json(400, {'error': 'cannot decode image'})
+        query = self.server.segmenter.preprocess([image[:, :, ::-1]])
+        output = self.server.batcher.predict(query, prototype)
+        mask = ((output > 0.5) * 255).astype(np.uint8)
+        mask = cv2.resize(mask, (image.shape[1], image.shape[0]), interpolation=cv2.INTER_NEAREST)
+        self.send_bytes(200, cv2.imencode('.png', mask)[1].tobytes(), 'image/png')
+
+    def register(self, support_id, body):
+        try:
+            request = json.loads(body.decode('utf-8'))
+            images = [decode_image(base64.b64decode(data)) for data in request['images']]
+            masks = [decode_image(base64.b64decode(data)) for data in request['masks']]
+        except (ValueError, KeyError, TypeError) as e:
+            return self.send_json(400, {'error': 'bad support request: %s' % e})
+        if not images or len(images) != len(masks) or any(x is None for x in images + masks):
+            return self.send_json(400, {'error': 'support needs one decodable mask per image'})
+        segmenter = self.server.segmenter
+        self.server.registry.put(support_id, segmenter.encode_support(
+            segmenter.preprocess([image[:, :, ::-1] for image in images], [mask[:, :, 0] for mask in masks])))
+        self.send_json(200, {'support_id': support_id, 'shots': len(images)})
+
+    def send_json(self, code, data):
+        self.send_bytes(code, json.dumps(data).encode('utf-8'), 'application/json')
+
+    def send_bytes(self, code, data, content_type):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket peers have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def decode_image(data):
+    """Decode an encoded image file into a 3-channel BGR array, None on failure."""
+    if not data:
+        return None
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def make_server(segmenter, host='127.0.0.1', port=8000, unix_socket='',
+                max_batch=16, max_latency_ms=10.0, support_dirs=None, shots=5,
+                registry_bytes=256 * 2 ** 20, spill_dir='', verbose=False):
+    """HTTP server answering with `segmenter`, not yet started.
+
+    `support_dirs` maps support-set ids to directories encoded on demand.
+    """
+    support_dirs = dict(support_dirs or {})
+
+    def load_support(support_id):
+        if support_id not in support_dirs:
+            return None
+        images, masks = read_support(support_dirs[support_id], shots)
+        return segmenter.encode_support(segmenter.preprocess(images, masks))
+
+    if unix_socket:
+        server = UnixHTTPServer(unix_socket, SegmentationHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), SegmentationHandler)
+    server.daemon_threads = True
+    server.segmenter = segmenter
+    server.batcher = MicroBatcher(segmenter, max_batch, max_latency_ms / 1000.0)
+    server.support_dirs = support_dirs
+    server.registry = SupportRegistry(registry_bytes, spill_dir, load_support, segmenter.device)
+    server.verbose = verbose
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Few-shot segmentation server")
+    parser.add_argument("-i", "--input_dim", type=int, default=224)
+    parser.add_argument("-s", "--sample_num_per_class", type=int, default=5)
+    parser.add_argument("-g", "--gpu", type=int, default=0)
+    parser.add_argument("-dev", "--device", type=str, default='auto')
+    parser.add_argument("-nt", "--num_threads", type=int, default=0)
+    parser.add_argument("-it", "--interop_threads", type=int, default=0)
+    parser.add_argument("-modelf", "--feature_encoder_model", type=str, default='models/feature_encoder.pkl')
+    parser.add_argument("-modelr", "--relation_network_model", type=str, default='models/relation_network.pkl')
+    parser.add_argument("-ss", "--support_set", type=str, action='append', default=[],
+                        help="id=support_dir, may be repeated")
+    parser.add_argument("--host", type=str, default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix_socket", type=str, default='')
+    parser.add_argument("-mb", "--max_batch", type=int, default=16)
+    parser.add_argument("-ml", "--max_latency_ms", type=float, default=10.0)
+    parser.add_argument("-rm", "--registry_mb", type=float, default=256)
+    parser.add_argument("-bn", "--running_stats", action='store_true')
+    parser.add_argument("-sp", "--spill_dir", type=str, default='')
+    parser.add_argument("-v", "--verbose", action='store_true')
+    args = parser.parse_args()
+
+    set_threads(args.num_threads, args.interop_threads)
+    segmenter = FewShotSegmenter(args.feature_encoder_model, args.relation_network_model,
+                                 args.input_dim, args.device, args.gpu, running_stats=args.running_stats)
+    support_dirs = dict(support_set.split('=', 1) for support_set in args.support_set)
+    server = make_server(segmenter, args.host, args.port, args.unix_socket,
+                         args.max_batch, args.max_latency_ms, support_dirs,
+                         args.sample_num_per_class, int(args.registry_mb * 2 ** 20),
+                         args.spill_dir, args.verbose)
+    print("%d support sets" % len(support_dirs))
+
+    print("serving on %s" % (args.unix_socket or 'http://%s:%d' % (args.host, args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
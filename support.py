@@ -0,0 +1,24 @@
+"""Support set discovery, without the heavy imports of segmenter.py.
+
+autolabel.py uses it to check the support directory before loading torch.
+"""
+import os
+
+
+def support_files(support_dir, shots=5):
+    """(image, label) file names of a support directory, paired by file stem.
+
+    The directory is laid out like imgs/example/support, with the images in
+    image/ and their labels in label/.
+    """
+    labelnames = sorted(os.listdir('%s/label' % support_dir))
+    imagenames = {os.path.splitext(name)[0]: name for name in os.listdir('%s/image' % support_dir)}
+    names = []
+    for labelname in labelnames:
+        stem = os.path.splitext(labelname)[0]
+        if stem not in imagenames:
+            raise Exception('no support image for label %s/label/%s' % (support_dir, labelname))
+        names.append((imagenames[stem], labelname))
+    if len(names) < shots:
+        raise Exception('%s support images needed in %s, found %s' % (shots, support_dir, len(names)))
+    return names[0:shots]
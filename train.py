@@ -1,16 +1,23 @@
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
 from torch.autograd import Variable
 from torch.optim.lr_scheduler import StepLR
-import torchvision.models as models
 import numpy as np
 import os
-import subprocess
-import math
 import argparse
 import random
-import cv2
+import copy
+import time
+import glob
+import torch.multiprocessing as mp
+from network import CNNEncoder, RelationNetwork, weights_init
+from device import get_device, set_threads, get_precision, autocast, peak_memory
+from segmenter import FewShotSegmenter
+from evaluate import evaluate, read_test_set
+from dataset import EpisodeSampler, episode_loader, benchmark
+from metrics import PhaseTimer, MetricsWriter
+from parallel import (init_distributed, get_rank, get_world_size, is_main, local_rank, default_threads,
+                      broadcast_networks, average_gradients, broadcast_int, barrier, launch)
 
 
 parser = argparse.ArgumentParser(description="One Shot Visual Recognition")
@@ -25,6 +32,9 @@ parser.add_argument("-start", "--start_episode", type=int, default=0)
 parser.add_argument("-t", "--test_episode", type=int, default=1000)
 parser.add_argument("-l", "--learning_rate", type=float, default=0.001)
 parser.add_argument("-g", "--gpu", type=int, default=0)
+parser.add_argument("-dev", "--device", type=str, default='auto')
+parser.add_argument("-nt", "--num_threads", type=int, default=0)
+parser.add_argument("-it", "--interop_threads", type=int, default=0)
 parser.add_argument("-u", "--hidden_unit", type=int, default=10)
 parser.add_argument("-d", "--display_query_num", type=int, default=5)
 parser.add_argument("-ex", "--exclude_class", type=int, default=6)
@@ -39,6 +49,33 @@ parser.add_argument("-rff", "--ResultSaveFreq", type=int, default=10000)
 parser.add_argument("-msp", "--ModelSavePath", type=str,
                     default='models_newvgg_1shot')
 parser.add_argument("-msf", "--ModelSaveFreq", type=int, default=10000)
+parser.add_argument("-dr", "--data_dir", type=str, default='support')
+parser.add_argument("-dc", "--data_cache", type=str, default='')
+parser.add_argument("-db", "--data_benchmark", type=int, default=0)
+parser.add_argument("-nw", "--num_workers", type=int, default=4)
+parser.add_argument("-pf", "--prefetch_factor", type=int, default=2)
+parser.add_argument("-pm", "--pin_memory", type=int, default=1)
+parser.add_argument("-seed", "--seed", type=int, default=None)
+parser.add_argument("-p", "--precision", type=str, default='fp32',
+                    choices=['fp32', 'fp16', 'bf16', 'auto'])
+parser.add_argument("-pb", "--precision_benchmark", type=int, default=0)
+parser.add_argument("-vs", "--val_set", type=str, default='')
+parser.add_argument("-vf", "--val_freq", type=int, default=500)
+parser.add_argument("-vq", "--val_queries", type=int, default=5)
+parser.add_argument("-tk", "--keep_top_k", type=int, default=3)
+parser.add_argument("-pat", "--patience", type=int, default=0)
+parser.add_argument("-md", "--min_delta", type=float, default=0.0)
+parser.add_argument("-rs", "--resume", type=str, default='')
+parser.add_argument("-sf", "--state_freq", type=int, default=1000)
+parser.add_argument("-ks", "--keep_states", type=int, default=2)
+parser.add_argument("-np", "--num_procs", type=int, default=1)
+parser.add_argument("-bk", "--backend", type=str, default='gloo')
+parser.add_argument("-sb", "--scaling_benchmark", type=int, default=0)
+parser.add_argument("-mf", "--metrics_file", type=str, default='')
+parser.add_argument("-mi", "--metrics_interval", type=int, default=10)
+parser.add_argument("-pe", "--profile_episodes", type=int, default=0)
+parser.add_argument("-ps", "--profile_start", type=int, default=10)
+parser.add_argument("-pt", "--profile_trace", type=str, default='trace.json')
 
 
 args = parser.parse_args()
@@ -63,216 +100,293 @@ input_dim = args.input_dim
 output_dim = input_dim // 32
 assert (input_dim%224==0)
 
-class CNNEncoder(nn.Module):
-    """docstring for ClassName"""
-
-    def __init__(self):
-        super(CNNEncoder, self).__init__()
-        features = list(models.vgg16_bn(pretrained=args.loadImagenet).features)
-        self.layer1 = nn.Sequential(
-            nn.Conv2d(4, 64, kernel_size=3, padding=1)
-        )
-        self.features = nn.ModuleList(features)[1:]  # .eval()
-        # print (nn.Sequential(*list(models.vgg16_bn(pretrained=True).children())[0]))
-        # self.features = nn.ModuleList(features).eval()
-
-    def forward(self, x):
-        results = []
-        x = self.layer1(x)
-        for ii, model in enumerate(self.features):
-            x = model(x)
-            if ii in {4, 11, 21, 31, 41}:
-                results.append(x)
-
-        return x, results
-
-
-class RelationNetwork(nn.Module):
-    """docstring for RelationNetwork"""
-
-    def __init__(self):
-        super(RelationNetwork, self).__init__()
-        self.layer1 = nn.Sequential(
-            nn.Conv2d(1024, 512, kernel_size=3, padding=1),
-            nn.BatchNorm2d(512, momentum=1, affine=True),
-            nn.ReLU()
-        )
-        self.layer2 = nn.Sequential(
-            nn.Conv2d(512, 512, kernel_size=3, padding=1),
-            nn.BatchNorm2d(512, momentum=1, affine=True),
-            nn.ReLU()
-        )
-        self.upsample = nn.Upsample(
-            scale_factor=2, mode='bilinear', align_corners=True)
-        self.double_conv1 = nn.Sequential(
-            nn.Conv2d(1024, 512, kernel_size=3, padding=1),
-            nn.BatchNorm2d(512, momentum=1, affine=True),
-            nn.ReLU(),
-            nn.Conv2d(512, 512, kernel_size=3, padding=1),
-            nn.BatchNorm2d(512, momentum=1, affine=True),
-            nn.ReLU()
-        )  # 14 x 14
-        self.double_conv2 = nn.Sequential(
-            nn.Conv2d(1024, 256, kernel_size=3, padding=1),
-            nn.BatchNorm2d(256, momentum=1, affine=True),
-            nn.ReLU(),
-            nn.Conv2d(256, 256, kernel_size=3, padding=1),
-            nn.BatchNorm2d(256, momentum=1, affine=True),
-            nn.ReLU()
-        )  # 28 x 28
-        self.double_conv3 = nn.Sequential(
-            nn.Conv2d(512, 128, kernel_size=3, padding=1),
-            nn.BatchNorm2d(128, momentum=1, affine=True),
-            nn.ReLU(),
-            nn.Conv2d(128, 128, kernel_size=3, padding=1),
-            nn.BatchNorm2d(128, momentum=1, affine=True),
-            nn.ReLU()
-        )  # 56 x 56
-        self.double_conv4 = nn.Sequential(
-            nn.Conv2d(256, 64, kernel_size=3, padding=1),
-            nn.BatchNorm2d(64, momentum=1, affine=True),
-            nn.ReLU(),
-            nn.Conv2d(64, 64, kernel_size=3, padding=1),
-            nn.BatchNorm2d(64, momentum=1, affine=True),
-            nn.ReLU()
-        )  # 112 x 112
-        self.double_conv5 = nn.Sequential(
-            nn.Conv2d(128, 64, kernel_size=3, padding=1),
-            nn.BatchNorm2d(64, momentum=1, affine=True),
-            nn.ReLU(),
-            nn.Conv2d(64, 1, kernel_size=1, padding=0),
-        )  # 256 x 256
-
-    def forward(self, x, concat_features):
-        out = self.layer1(x)
-        out = self.layer2(out)
-        out = self.upsample(out)  # block 1
-        out = torch.cat((out, concat_features[-1]), dim=1)
-        out = self.double_conv1(out)
-        out = self.upsample(out)  # block 2
-        out = torch.cat((out, concat_features[-2]), dim=1)
-        out = self.double_conv2(out)
-        out = self.upsample(out)  # block 3
-        out = torch.cat((out, concat_features[-3]), dim=1)
-        out = self.double_conv3(out)
-        out = self.upsample(out)  # block 4
-        out = torch.cat((out, concat_features[-4]), dim=1)
-        out = self.double_conv4(out)
-        out = self.upsample(out)  # block 5
-        out = torch.cat((out, concat_features[-5]), dim=1)
-        out = self.double_conv5(out)
-
-        out = F.sigmoid(out)
-        return out
-
-
-def weights_init(m):
-    classname = m.__class__.__name__
-    if classname.find('Conv') != -1:
-        n = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
-        m.weight.data.normal_(0, math.sqrt(2. / n))
-        if m.bias is not None:
-            m.bias.data.zero_()
-    elif classname.find('BatchNorm') != -1:
-        m.weight.data.fill_(1)
-        m.bias.data.zero_()
-    elif classname.find('Linear') != -1:
-        n = m.weight.size(1)
-        m.weight.data.normal_(0, 0.01)
-        m.bias.data = torch.ones(m.bias.data.size())
-
-
-def get_oneshot_batch():  # shuffle in query_images not done
-    # classes.remove(EXCLUDE_CLASS)
-    classes_name = os.listdir('support/')
-    classes = list(range(0, len(classes_name)))
-
-    chosen_classes = random.sample(classes, CLASS_NUM)
-    support_images = np.zeros(
-        (CLASS_NUM*SAMPLE_NUM_PER_CLASS, 3, input_dim, input_dim), dtype=np.float32)
-    support_labels = np.zeros(
-        (CLASS_NUM*SAMPLE_NUM_PER_CLASS, CLASS_NUM, input_dim, input_dim), dtype=np.float32)
-    query_images = np.zeros(
-        (CLASS_NUM*BATCH_NUM_PER_CLASS, 3, input_dim, input_dim), dtype=np.float32)
-    query_labels = np.zeros(
-        (CLASS_NUM*BATCH_NUM_PER_CLASS, CLASS_NUM, input_dim, input_dim), dtype=np.float32)
-    zeros = np.zeros((CLASS_NUM*BATCH_NUM_PER_CLASS,
-                      1, input_dim, input_dim), dtype=np.float32)
-    class_cnt = 0
-    for i in chosen_classes:
-        # print ('class %s is chosen' % i)
-        imgnames = os.listdir('support/%s/label' % classes_name[i])
-        indexs = list(range(0, len(imgnames)))
-        chosen_index = random.sample(
-            indexs, SAMPLE_NUM_PER_CLASS + BATCH_NUM_PER_CLASS)
-        j = 0
-        for k in chosen_index:
-            # process image
-            image = cv2.imread('support/%s/image/%s' %
-                               (classes_name[i], imgnames[k]))
-            if not image.shape[0] == input_dim:
-                image = cv2.resize(image, (input_dim, input_dim))
-            if image is None:
-                print('support/%s/image/%s' % (classes_name[i], imgnames[k]))
-                stop
-            image = image[:, :, ::-1]  # bgr to rgb
-            image = image / 255.0
-            image = np.transpose(image, (2, 0, 1))
-            # labels
-            label = cv2.imread('support/%s/label/%s' %
-                               (classes_name[i], imgnames[k]))[:, :, 0]
-            if not label.shape[0] == input_dim:
-                label = cv2.resize(label, (input_dim, input_dim),
-                                   interpolation=cv2.INTER_NEAREST)
-            if j < SAMPLE_NUM_PER_CLASS:
-                support_images[j] = image
-                support_labels[j][0] = label
-            else:
-                query_images[j-SAMPLE_NUM_PER_CLASS] = image
-                query_labels[j-SAMPLE_NUM_PER_CLASS][class_cnt] = label
-            j += 1
-
-        class_cnt += 1
-    support_images_tensor = torch.from_numpy(support_images)
-    support_labels_tensor = torch.from_numpy(support_labels)
-    support_images_tensor = torch.cat(
-        (support_images_tensor, support_labels_tensor), dim=1)
-
-    zeros_tensor = torch.from_numpy(zeros)
-    query_images_tensor = torch.from_numpy(query_images)
-    query_images_tensor = torch.cat((query_images_tensor, zeros_tensor), dim=1)
-    query_labels_tensor = torch.from_numpy(query_labels)
-
-    return support_images_tensor, support_labels_tensor, query_images_tensor, query_labels_tensor, chosen_classes
+def train_step(feature_encoder, relation_network, optims, scaler,
+               samples, batches, batch_labels, device, precision, timer=None):
+    """One optimisation step of both networks on an episode, returns the loss.
 
+    The phases of the step are timed by `timer`, a metrics.PhaseTimer.
+    """
+    timer = timer or PhaseTimer(enabled=False)
+    with autocast(device, precision):
+        # calculate features
+        with timer.phase('support_forward'):
+            sample_features, _ = feature_encoder(Variable(samples).to(device))
+            # sample_features = sample_features.view(CLASS_NUM,SAMPLE_NUM_PER_CLASS,512,7,7)
+            sample_features = sample_features.view(
+                CLASS_NUM, SAMPLE_NUM_PER_CLASS, 512, output_dim, output_dim)
+            sample_features = torch.sum(sample_features, 1).squeeze(1)  # 1*512*7*7
+        with timer.phase('query_forward'):
+            batch_features, ft_list = feature_encoder(Variable(batches).to(device))
+
+        # calculate relations, the query features are shared by all ways
+        with timer.phase('relation_forward'):
+            output = relation_network.forward_ways(sample_features, batch_features, ft_list)
+
+    # training
+    with timer.phase('backward'):
+        # the loss is always computed in fp32
+        mse = nn.MSELoss()
+        loss = mse(output.float(), Variable(batch_labels).to(device))
 
-def main():
+        feature_encoder.zero_grad()
+        relation_network.zero_grad()
 
-    # Step 1: init neural networks
-    print("init neural networks")
+        # the scaler is a no-op unless training in fp16
+        scaler.scale(loss).backward()
+    # a no-op unless training data-parallel
+    with timer.phase('all_reduce'):
+        average_gradients((feature_encoder, relation_network))
+
+    with timer.phase('optimizer_step'):
+        for optim in optims:
+            scaler.unscale_(optim)
+
+        torch.nn.utils.clip_grad_norm_(feature_encoder.parameters(), 0.5)
+        torch.nn.utils.clip_grad_norm_(relation_network.parameters(), 0.5)
+
+        for optim in optims:
+            scaler.step(optim)
+        scaler.update()
+    return loss
+
+
+def training_sampler(exclude=()):
+    """EpisodeSampler over the training data, the data cache is built by rank 0 only.
+
+    The other ranks wait for it, otherwise each of them would write the
+    same cache file at the same time.
+    """
+    if args.data_cache and not is_main():
+        barrier()
+    sampler = EpisodeSampler(args.data_dir, input_dim, CLASS_NUM, SAMPLE_NUM_PER_CLASS,
+                             BATCH_NUM_PER_CLASS, args.data_cache, exclude=exclude)
+    if args.data_cache and is_main():
+        barrier()
+    return sampler
+
+
+def precision_worker(feature_encoder, relation_network, seed, device, precision, episodes, results):
+    """Train the networks for `episodes` steps in `precision`, put (episodes/sec, peak memory) in `results`."""
+    set_threads(args.num_threads or default_threads(), args.interop_threads)
+    sampler = training_sampler(read_test_set(args.val_set) if args.val_set else ())
+    feature_encoder.to(device)
+    relation_network.to(device)
+    optims = (torch.optim.Adam(feature_encoder.parameters(), lr=LEARNING_RATE),
+              torch.optim.Adam(relation_network.parameters(), lr=LEARNING_RATE))
+    scaler = torch.amp.GradScaler('cuda', enabled=precision == 'fp16')
+    start = time.time()
+    for samples, sample_labels, batches, batch_labels, chosen_classes in episode_loader(
+            sampler, 0, episodes, seed, args.num_workers, args.prefetch_factor):
+        train_step(feature_encoder, relation_network, optims, scaler,
+                   samples, batches, batch_labels, device, precision)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    results.put((episodes / (time.time() - start), peak_memory(device)))
+
+
+def benchmark_precision(feature_encoder, relation_network, seed, device, precisions, episodes):
+    """Print episodes/sec and peak memory of training copies of the networks in each precision.
+
+    Each precision trains in a fresh process: on the CPU the peak memory is
+    the process's max RSS, which would otherwise carry over from the
+    previous precision.
+    """
+    context = mp.get_context('spawn')
+    results = context.SimpleQueue()
+    for precision in precisions:
+        process = context.Process(target=precision_worker, args=(
+            copy.deepcopy(feature_encoder).cpu(), copy.deepcopy(relation_network).cpu(),
+            seed, device, precision, episodes, results))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise Exception('precision benchmark failed in %s' % precision)
+        episodes_per_sec, memory = results.get()
+        log("%s: %.2f episodes/sec, peak memory %.0fMB" % (precision, episodes_per_sec, memory / 2.0**20))
+
+
+def log(*values):
+    """print() on the rank that logs, all ranks run the same code."""
+    if is_main():
+        print(*values)
+
+
+def scaling_worker(episodes, results):
+    """Train fresh networks for `episodes` steps on this rank, rank 0 puts the episodes/sec of all ranks in `results`."""
+    rank, world_size = get_rank(), get_world_size()
+    device = get_device(args.device, GPU + local_rank())
+    set_threads(args.num_threads or default_threads(), args.interop_threads)
+    precision = get_precision(args.precision, device)
+    sampler = training_sampler()
+    feature_encoder = CNNEncoder().to(device)
+    relation_network = RelationNetwork()
+    relation_network.apply(weights_init)
+    relation_network.to(device)
+    broadcast_networks((feature_encoder, relation_network))
+    optims = (torch.optim.Adam(feature_encoder.parameters(), lr=LEARNING_RATE),
+              torch.optim.Adam(relation_network.parameters(), lr=LEARNING_RATE))
+    scaler = torch.amp.GradScaler('cuda', enabled=precision == 'fp16')
+    warmup = 2
+    loader = episode_loader(sampler, 0, warmup + episodes, 0, args.num_workers, args.prefetch_factor,
+                            rank=rank, world_size=world_size)
+    for step, (samples, sample_labels, batches, batch_labels, chosen_classes) in enumerate(loader):
+        if step == warmup:
+            barrier()
+            start = time.time()
+        train_step(feature_encoder, relation_network, optims, scaler,
+                   samples, batches, batch_labels, device, precision)
+    barrier()
+    if rank == 0:
+        results.put(world_size * episodes / (time.time() - start))
+
+
+def benchmark_scaling(episodes, num_procs=(1, 2, 4)):
+    """Print the episodes/sec of data-parallel training in 1, 2 and 4 local processes."""
+    results = mp.get_context('spawn').SimpleQueue()
+    base = None
+    for n in num_procs:
+        launch(scaling_worker, n, (episodes, results), args.backend)
+        rate = results.get()
+        base = base or rate
+        print("%d processes: %.2f episodes/sec, %.2fx, efficiency %.0f%%" % (
+            n, rate, rate / base, 100 * rate / base / n))
+
+
+def save_networks(feature_encoder, relation_network, episode, suffix=''):
+    """Save both networks' state dicts for `episode`, returns the paths."""
+    name = str(episode) + '_' + str(CLASS_NUM) + "_way_" + str(SAMPLE_NUM_PER_CLASS) + "shot" + suffix + ".pkl"
+    paths = ["./%s/feature_encoder_%s" % (args.ModelSavePath, name),
+             "./%s/relation_network_%s" % (args.ModelSavePath, name)]
+    torch.save(feature_encoder.state_dict(), paths[0])
+    torch.save(relation_network.state_dict(), paths[1])
+    return paths
+
+
+def validate(feature_encoder, relation_network, sampler, val_classes, device, seed):
+    """Mean IoU on the held-out classes, on the same episodes at every call."""
+    # copies, the segmenter replaces their batch norm layers
+    segmenter = FewShotSegmenter.from_networks(copy.deepcopy(feature_encoder), copy.deepcopy(relation_network),
+                                               input_dim, device)
+    report = evaluate(segmenter, sampler, val_classes, SAMPLE_NUM_PER_CLASS, args.val_queries,
+                      batch_size=BATCH_NUM_PER_CLASS, seed=seed)
+    return report['mean_iou']
+
+
+class TopKCheckpoints(object):
+    """Keep the files of the k best validated checkpoints and delete the others."""
+
+    def __init__(self, k):
+        self.k = k
+        self.kept = []  # (score, paths), best first
+
+    def add(self, score, save):
+        """Call save() and keep its files if `score` is among the k best."""
+        if len(self.kept) >= self.k and score <= self.kept[-1][0]:
+            return False
+        self.kept.append((score, save()))
+        self.kept.sort(key=lambda kept: -kept[0])
+        for _, paths in self.kept[self.k:]:
+            for path in paths:
+                os.remove(path)
+        del self.kept[self.k:]
+        return True
+
+
+def state_path(episode):
+    return "./%s/state_%08d.pt" % (args.ModelSavePath, episode)
+
+
+def latest_state():
+    """Path of the training state with the highest episode in ModelSavePath, '' if there is none."""
+    paths = sorted(glob.glob("./%s/state_*.pt" % args.ModelSavePath))
+    return paths[-1] if paths else ''
+
+
+def save_state(path, state):
+    """Save a training state dict to `path` atomically, a crash never leaves a partial file."""
+    state['rng'] = {'python': random.getstate(), 'numpy': np.random.get_state(),
+                    'torch': torch.get_rng_state(),
+                    'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []}
+    torch.save(state, path + '.tmp')
+    os.replace(path + '.tmp', path)
+    # older states are only kept as a fallback, the state just saved always stays
+    for old in sorted(glob.glob("./%s/state_*.pt" % args.ModelSavePath))[:-max(args.keep_states, 1)]:
+        os.remove(old)
+
+
+def load_state(path):
+    # the states hold Python and NumPy RNG states, not only tensors
+    return torch.load(path, map_location='cpu', weights_only=False)
+
+
+def set_rng_state(rng):
+    random.setstate(rng['python'])
+    np.random.set_state(rng['numpy'])
+    torch.set_rng_state(rng['torch'])
+    if rng['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng['cuda'])
 
-    feature_encoder = CNNEncoder()
+
+def main():
+    rank, world_size = init_distributed(args.backend)
+
+    # Step 1: init data
+    # the dataset is arranged as described in dataset.py
+    log("init dataset index")
+    # validation classes are held out of training
+    val_classes = read_test_set(args.val_set) if args.val_set else set()
+    sampler = training_sampler(val_classes)
+    log("%d classes, %d for training" % (len(sampler.index), len(sampler.classes)))
+    state = None
+    resume = latest_state() if args.resume == 'auto' else args.resume
+    if resume:
+        state = load_state(resume)
+        log("resuming from %s after episode %d" % (resume, state['episode']))
+    elif args.resume == 'auto':
+        log("no training state in %s, starting from scratch" % args.ModelSavePath)
+    # the episodes only depend on the seed, a resumed run must keep it
+    seed = state['seed'] if state else args.seed if args.seed is not None else random.randrange(2**31)
+    seed = broadcast_int(seed)
+    log("seed %d" % seed)
+    random.seed(seed)
+    torch.manual_seed(seed)
+    if args.data_benchmark:
+        log("decoding from disk: %.2f episodes/sec" % benchmark(
+            EpisodeSampler(args.data_dir, input_dim, CLASS_NUM, SAMPLE_NUM_PER_CLASS,
+                           BATCH_NUM_PER_CLASS), args.data_benchmark))
+        if args.data_cache:
+            log("memory-mapped cache: %.2f episodes/sec" % benchmark(sampler, args.data_benchmark))
+        return
+
+    # Step 2: init neural networks
+    log("init neural networks")
+
+    feature_encoder = CNNEncoder(pretrained=args.loadImagenet)
     relation_network = RelationNetwork()
 
     relation_network.apply(weights_init)
 
-    feature_encoder.cuda(GPU)
-    relation_network.cuda(GPU)
+    device = get_device(args.device, GPU + local_rank())
+    set_threads(args.num_threads or default_threads(), args.interop_threads)
+    log("training on %s" % device + (", %d processes" % world_size if world_size > 1 else ""))
+
+    feature_encoder.to(device)
+    relation_network.to(device)
 
     # fine-tuning
     if (args.finetune):
         if os.path.exists(FEATURE_MODEL):
-            feature_encoder.load_state_dict(torch.load(FEATURE_MODEL))
-            print("load feature encoder success")
+            feature_encoder.load_state_dict(torch.load(FEATURE_MODEL, map_location=device))
+            log("load feature encoder success")
         else:
-            print('Can not load feature encoder: %s' % FEATURE_MODEL)
-            print('starting from scratch')
+            log('Can not load feature encoder: %s' % FEATURE_MODEL)
+            log('starting from scratch')
         if os.path.exists(RELATION_MODEL):
-            relation_network.load_state_dict(torch.load(RELATION_MODEL))
-            print("load relation network success")
+            relation_network.load_state_dict(torch.load(RELATION_MODEL, map_location=device))
+            log("load relation network success")
         else:
-            print('Can not load relation network: %s' % RELATION_MODEL)
-            print('starting from scratch')
+            log('Can not load relation network: %s' % RELATION_MODEL)
+            log('starting from scratch')
 
     feature_encoder_optim = torch.optim.Adam(
         feature_encoder.parameters(), lr=LEARNING_RATE)
@@ -283,70 +397,163 @@ def main():
     relation_network_scheduler = StepLR(
         relation_network_optim, step_size=EPISODE//10, gamma=0.5)
 
-    print("Training...")
+    precision = get_precision(args.precision, device)
+    if args.precision_benchmark:
+        if is_main():
+            benchmark_precision(feature_encoder, relation_network, seed, device,
+                                ['fp32'] if precision == 'fp32' else ['fp32', precision],
+                                args.precision_benchmark)
+        return
+    log("training in %s" % precision)
+    scaler = torch.amp.GradScaler('cuda', enabled=precision == 'fp16')
+
+    checkpoints = TopKCheckpoints(args.keep_top_k)
+    best_miou = float('-inf')
+    stale = 0
+    start_episode = args.start_episode
+
+    if state:
+        feature_encoder.load_state_dict(state['feature_encoder'])
+        relation_network.load_state_dict(state['relation_network'])
+        feature_encoder_optim.load_state_dict(state['feature_encoder_optim'])
+        relation_network_optim.load_state_dict(state['relation_network_optim'])
+        feature_encoder_scheduler.load_state_dict(state['feature_encoder_scheduler'])
+        relation_network_scheduler.load_state_dict(state['relation_network_scheduler'])
+        scaler.load_state_dict(state['scaler'])
+        checkpoints.kept = state['checkpoints']
+        best_miou, stale = state['best_miou'], state['stale']
+        set_rng_state(state['rng'])
+        start_episode = state['episode'] + 1
+    # every rank starts from rank 0's networks
+    broadcast_networks((feature_encoder, relation_network))
+
+    def training_state(episode):
+        return {'episode': episode, 'seed': seed,
+                'feature_encoder': feature_encoder.state_dict(),
+                'relation_network': relation_network.state_dict(),
+                'feature_encoder_optim': feature_encoder_optim.state_dict(),
+                'relation_network_optim': relation_network_optim.state_dict(),
+                'feature_encoder_scheduler': feature_encoder_scheduler.state_dict(),
+                'relation_network_scheduler': relation_network_scheduler.state_dict(),
+                'scaler': scaler.state_dict(),
+                'checkpoints': checkpoints.kept, 'best_miou': best_miou, 'stale': stale}
+
+    log("Training...")
 
     last_accuracy = 0.0
-
-    for episode in range(args.start_episode, EPISODE):
+    start = time.time()
+
+    if is_main() and not os.path.exists(args.TrainResultPath):
+        os.makedirs(args.TrainResultPath)
+    if is_main() and not os.path.exists(args.ModelSavePath):
+        os.makedirs(args.ModelSavePath)
+
+    # phases are only timed when they are written out, timing synchronizes CUDA,
+    # and labelled for the profiler when it runs
+    profiling = bool(args.profile_episodes) and is_main()
+    timer = PhaseTimer(device, enabled=bool(args.metrics_file), labels=bool(args.metrics_file) or profiling)
+    metrics = MetricsWriter(args.metrics_file if is_main() else '')
+    metrics.write({'event': 'start', 'config': vars(args), 'seed': seed, 'device': str(device),
+                   'precision': precision, 'world_size': world_size, 'start_episode': start_episode})
+    profiler = None
+    if profiling:
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if device.type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        # one warm-up episode before the window
+        profiler = torch.profiler.profile(
+            activities=activities, record_shapes=True,
+            schedule=torch.profiler.schedule(wait=max(args.profile_start - 1, 0), warmup=1,
+                                             active=args.profile_episodes, repeat=1),
+            on_trace_ready=lambda p: p.export_chrome_trace(args.profile_trace))
+        profiler.start()
+
+    # each rank trains on its own episodes, a step trains on world_size episodes
+    loader = episode_loader(sampler, start_episode, EPISODE, seed, args.num_workers,
+                            args.prefetch_factor, bool(args.pin_memory) and device.type == 'cuda',
+                            rank, world_size)
+
+    interval_start, interval_episode = time.time(), start_episode
+    episode = start_episode - 1  # the last episode trained
+    for episode, (samples, sample_labels, batches, batch_labels, chosen_classes) in zip(
+            range(start_episode, EPISODE), timer.iterate(loader, 'sampling')):
         feature_encoder_scheduler.step(episode)
         relation_network_scheduler.step(episode)
 
-        samples, sample_labels, batches, batch_labels, chosen_classes = get_oneshot_batch()
-
-        # calculate features
-        sample_features, _ = feature_encoder(Variable(samples).cuda(GPU))
-        # sample_features = sample_features.view(CLASS_NUM,SAMPLE_NUM_PER_CLASS,512,7,7)
-        sample_features = sample_features.view(
-            CLASS_NUM, SAMPLE_NUM_PER_CLASS, 512, output_dim, output_dim)
-        sample_features = torch.sum(sample_features, 1).squeeze(1)  # 1*512*7*7
-        batch_features, ft_list = feature_encoder(Variable(batches).cuda(GPU))
-
-        # calculate relations
-        sample_features_ext = sample_features.unsqueeze(
-            0).repeat(BATCH_NUM_PER_CLASS*CLASS_NUM, 1, 1, 1, 1)
-        batch_features_ext = batch_features.unsqueeze(
-            0).repeat(CLASS_NUM, 1, 1, 1, 1)
-        batch_features_ext = torch.transpose(batch_features_ext, 0, 1)
-
-        # relation_pairs = torch.cat((sample_features_ext,batch_features_ext),2).view(-1,1024,7,7)
-        relation_pairs = torch.cat(
-            (sample_features_ext, batch_features_ext), 2).view(-1, 1024, output_dim, output_dim)
-        # output = relation_network(relation_pairs,ft_list).view(-1,CLASS_NUM,224,224)
-        output = relation_network(
-            relation_pairs, ft_list).view(-1, CLASS_NUM, input_dim, input_dim)
-
-        mse = nn.MSELoss().cuda(GPU)
-        loss = mse(output, Variable(batch_labels).cuda(GPU))
-
-        # training
-
-        feature_encoder.zero_grad()
-        relation_network.zero_grad()
-
-        loss.backward()
-
-        torch.nn.utils.clip_grad_norm(feature_encoder.parameters(), 0.5)
-        torch.nn.utils.clip_grad_norm(relation_network.parameters(), 0.5)
-
-        feature_encoder_optim.step()
-        relation_network_optim.step()
-
-        if (episode+1) % 10 == 0:
-            print("episode:", episode+1, "loss", loss.cpu().data.numpy())
-
-        if not os.path.exists(args.TrainResultPath):
-            os.makedirs(args.TrainResultPath)
-        if not os.path.exists(args.ModelSavePath):
-            os.makedirs(args.ModelSavePath)
-
-        # save models
-        if (episode+1) % args.ModelSaveFreq == 0:
-            torch.save(feature_encoder.state_dict(), str("./%s/feature_encoder_" % args.ModelSavePath +
-                                                         str(episode) + '_' + str(CLASS_NUM) + "_way_" + str(SAMPLE_NUM_PER_CLASS) + "shot.pkl"))
-            torch.save(relation_network.state_dict(), str("./%s/relation_network_" % args.ModelSavePath +
-                                                          str(episode) + '_' + str(CLASS_NUM) + "_way_" + str(SAMPLE_NUM_PER_CLASS) + "shot.pkl"))
-            print("save networks for episode:", episode)
+        loss = train_step(feature_encoder, relation_network,
+                          (feature_encoder_optim, relation_network_optim), scaler,
+                          samples, batches, batch_labels, device, precision, timer)
+
+        # save models, the last episode is always saved
+        if is_main() and ((episode+1) % args.ModelSaveFreq == 0 or episode+1 == EPISODE):
+            with timer.phase('checkpoint'):
+                save_networks(feature_encoder, relation_network, episode)
+            log("save networks for episode:", episode)
+
+        if val_classes and (episode+1) % args.val_freq == 0:
+            stop = False
+            if is_main():
+                with timer.phase('validation'):
+                    miou = validate(feature_encoder, relation_network, sampler, val_classes, device, seed)
+                log("episode:", episode+1, "validation mean IoU %.4f" % miou)
+                metrics.write({'event': 'validation', 'episode': episode+1, 'mean_iou': miou})
+                with timer.phase('checkpoint'):
+                    kept = checkpoints.add(miou, lambda: save_networks(feature_encoder, relation_network,
+                                                                       episode, "_val%.4f" % miou))
+                if kept:
+                    log("kept among the %d best checkpoints" % args.keep_top_k)
+                if miou > best_miou + args.min_delta:
+                    best_miou = miou
+                    stale = 0
+                else:
+                    stale += 1
+                    stop = bool(args.patience) and stale >= args.patience
+            # all ranks stop together
+            if broadcast_int(stop):
+                log("no improvement in %d validations, stopping" % stale)
+                if is_main():
+                    save_state(state_path(episode), training_state(episode))
+                break
+
+        if is_main() and ((episode+1) % args.state_freq == 0 or episode+1 == EPISODE):
+            with timer.phase('checkpoint'):
+                save_state(state_path(episode), training_state(episode))
+
+        # after the checkpoint and validation phases, so they count in this episode's interval
+        if (episode+1) % args.metrics_interval == 0:
+            now = time.time()
+            episodes = episode+1 - interval_episode
+            episodes_per_sec = episodes * world_size / (now - interval_start)
+            memory = peak_memory(device) / 2.0**20
+            log("episode:", episode+1, "loss", loss.cpu().data.numpy(),
+                "episodes/sec %.2f" % episodes_per_sec, "peak memory %.0fMB" % memory)
+            metrics.write({'event': 'episodes', 'episode': episode+1, 'loss': float(loss),
+                           'episodes_per_sec': episodes_per_sec, 'peak_memory_mb': memory,
+                           'phase_ms': {name: 1000 * seconds / episodes
+                                        for name, seconds in timer.reset().items()}})
+            interval_start, interval_episode = now, episode+1
+
+        if profiler is not None:
+            profiler.step()
+
+    if profiler is not None:
+        profiler.stop()
+        log("profiler trace written to %s" % args.profile_trace)
+    # phases of the episodes after the last full interval
+    episodes = max(episode+1 - interval_episode, 1)
+    metrics.write({'event': 'end', 'episodes_per_sec': (episode+1 - start_episode) * world_size
+                   / (time.time() - start), 'peak_memory_mb': peak_memory(device) / 2.0**20,
+                   'phase_ms': {name: 1000 * seconds / episodes for name, seconds in timer.reset().items()}})
+    metrics.close()
+
+    if checkpoints.kept:
+        log("best checkpoint: validation mean IoU %.4f, %s" % checkpoints.kept[0][:2])
 
 
 if __name__ == '__main__':
-    main()
+    if args.scaling_benchmark:
+        benchmark_scaling(args.scaling_benchmark)
+    elif args.num_procs > 1 and 'WORLD_SIZE' not in os.environ:
+        launch(main, args.num_procs, backend=args.backend)
+    else:
+        main()